@@ -4,28 +4,35 @@ Generic helpers
 
 import logging
 import os
+from typing import Any, Dict, Optional
 
 log = logging.getLogger(__name__)
 
 
 class ImageLabel:
+    _labels: Optional[Dict[str, str]] = None
+
     def __init__(self, config, name: str, version: str):
         self.namespace = config.get("namespace", "")
         self.registry = config.get("registry", "")
         self.short_name = name
         self.version = version
 
+    def __setattr__(self, name: str, value: Any):
+        super().__setattr__(name, value)
+        # Labels are computed once and cached; any change to their components resets them.
+        super().__setattr__("_labels", None)
+
     def label(self, spec: str = "name") -> str:
-        if spec == "short":
-            return self.short_name
-        elif spec == "name":
-            return self._fn()
-        elif spec == "full":
-            return f"{self._fn()}:{self.version}"
-        raise ValueError("Only 'short', 'name' and 'full' labels are supported.")
-
-    def _fn(self):
-        return os.path.join(self.registry, self.namespace, self.short_name)
+        labels = self._labels
+        if labels is None:
+            fn = os.path.join(self.registry, self.namespace, self.short_name)
+            labels = {"short": self.short_name, "name": fn, "full": f"{fn}:{self.version}"}
+            super().__setattr__("_labels", labels)
+        try:
+            return labels[spec]
+        except KeyError:
+            raise ValueError("Only 'short', 'name' and 'full' labels are supported.")
 
     # Utility methods
     def name(self) -> str:
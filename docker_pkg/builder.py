@@ -1,18 +1,240 @@
 """
 Workflow to process, build and publish image definitions
 """
+import fcntl
 import fnmatch
+import functools
+import json
 import os
-from concurrent.futures import ThreadPoolExecutor
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from threading import Lock
-from typing import Any, Dict, Generator, List, Optional, Set
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    MutableSet,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+)
 
 import docker
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from docker_pkg import drivers, image, log
+from docker_pkg import dockerfile, drivers, image, log
 
-mutex = Lock()
+
+class ManifestCache:
+    """
+    On-disk cache of the ETags returned by the registry for image manifests.
+
+    Entries are keyed by manifest url, and allow us to perform conditional requests
+    to the registry. The file is shared between threads and processes, so every
+    write happens under an exclusive lock and merges with what's already on disk.
+
+    The cache also remembers the manifests found in the registry by this process,
+    which don't need to be looked up again.
+
+    path: the file storing the ETags. Default: $XDG_CACHE_HOME/docker-pkg/manifests.json.
+    persistent: if false, nothing is read from or written to the file.
+    """
+
+    def __init__(self, path: Optional[str] = None, persistent: bool = True):
+        self._path = path
+        self.persistent = persistent
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self._lock = Lock()
+        self._published: Set[str] = set()
+
+    @property
+    def path(self) -> str:
+        if self._path is None:
+            xdg_cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache/"))
+            self._path = os.path.join(xdg_cache_home, "docker-pkg", "manifests.json")
+        return self._path
+
+    def _read(self, fh) -> Dict[str, Dict[str, Any]]:
+        fh.seek(0)
+        try:
+            data = json.load(fh)
+        except ValueError:
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._entries is None:
+            try:
+                with open(self.path, "r") as fh:
+                    fcntl.flock(fh, fcntl.LOCK_SH)
+                    self._entries = self._read(fh)
+            except OSError:
+                self._entries = {}
+        return self._entries
+
+    def etag(self, url: str) -> Optional[str]:
+        """Returns the last known ETag for the manifest url, if any"""
+        if not self.persistent:
+            return None
+        with self._lock:
+            return self._load().get(url, {}).get("etag")
+
+    def is_published(self, url: str) -> bool:
+        """True if the manifest url was already found in the registry"""
+        return url in self._published
+
+    def set_published(self, url: str):
+        """Record that the manifest url was found in the registry"""
+        self._published.add(url)
+
+    def update(self, url: str, etag: str, status: int):
+        """Record the ETag for the manifest url, if it changed"""
+        if not self.persistent:
+            return
+        with self._lock:
+            entries = self._load()
+            if entries.get(url, {}).get("etag") == etag:
+                return
+            entries[url] = {"etag": etag, "status": status}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a+") as fh:
+                    fcntl.flock(fh, fcntl.LOCK_EX)
+                    # Merge with whatever other processes wrote in the meantime.
+                    on_disk = self._read(fh)
+                    on_disk.update(entries)
+                    fh.seek(0)
+                    fh.truncate()
+                    json.dump(on_disk, fh)
+                self._entries = on_disk
+            except OSError as e:
+                log.debug("Could not write the manifest cache %s: %s", self.path, e)
+
+
+manifest_cache = ManifestCache()
+
+# Shared HTTP session for registry lookups, so that scan() reuses keep-alive
+# connections (and TLS sessions) across images and worker threads.
+session = requests.Session()
+session_pool_size = 0
+
+
+def ensure_session_pool(size: int):
+    """Make sure the registry session can keep at least size connections per host"""
+    global session_pool_size
+    if size <= session_pool_size:
+        return
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=size,
+            pool_maxsize=size,
+            # Retry on transient registry errors too; if they persist, we get the last
+            # response back and probe_manifest fails, rather than rebuilding the image.
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.3,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False,
+            ),
+        ),
+    )
+    session_pool_size = size
+
+
+ensure_session_pool(32)
+
+
+# Manifest formats we accept from the registry; registries might report a manifest
+# as missing if it's not in one of the formats the client declares to accept.
+MANIFEST_MEDIA_TYPES = ", ".join(
+    [
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.oci.image.index.v1+json",
+    ]
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _registry_base_url(registry: str, namespace: str) -> str:
+    """Base url of the images in a namespace of the registry"""
+    if namespace:
+        return f"https://{registry}/v2/{namespace}"
+    return f"https://{registry}/v2"
+
+
+def probe_manifest(config: Dict[str, Any], name: str, tag: str) -> bool:
+    """Check if the manifest for name:tag is present in the configured registry"""
+    if not config.get("registry", False):
+        # TODO: support dockerhub somehow!
+        # Probably will need a different strategy there.
+        return False
+    base_url = _registry_base_url(config["registry"], config.get("namespace") or "")
+    manifest_url = f"{base_url}/{name}/manifests/{tag}"
+    # A published image doesn't go away, but one not found might get published later.
+    if manifest_cache.is_published(manifest_url):
+        return True
+    proxies = {"https": config.get("http_proxy", None)}
+    headers = {"Accept": MANIFEST_MEDIA_TYPES}
+    etag = manifest_cache.etag(manifest_url)
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    # We only care about the status code and the ETag, so don't download the manifest.
+    resp = session.head(
+        manifest_url, proxies=proxies, headers=headers, timeout=(3.05, 30), allow_redirects=True
+    )
+    # Don't assume the image is missing if the registry is failing, we'd build it again.
+    if resp.status_code >= 500:
+        resp.raise_for_status()
+    if resp.status_code == requests.codes.not_modified:
+        manifest_cache.set_published(manifest_url)
+        return True
+    if resp.status_code != requests.codes.ok:
+        return False
+    new_etag = resp.headers.get("ETag")
+    if new_etag is not None:
+        manifest_cache.update(manifest_url, new_etag, resp.status_code)
+    manifest_cache.set_published(manifest_url)
+    return True
+
+
+def _walk(top: str) -> Generator[Tuple[str, List[str], Set[str]], None, None]:
+    """
+    Top-down directory walk, like os.walk
+
+    Differently from os.walk, files are returned as a set, and directories are
+    told apart using the information cached in the directory entries, without
+    further stat() calls. Symlinks are never followed. As with os.walk, the
+    caller can prune the walk by modifying the list of directories in place.
+    """
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        dirs: List[str] = []
+        files: Set[str] = set()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    else:
+                        files.add(entry.name)
+        except OSError:
+            continue
+        yield path, dirs, files
+        stack.extend(os.path.join(path, d) for d in reversed(dirs))
 
 
 class ImageFSM:
@@ -38,30 +260,45 @@ class ImageFSM:
     STATES = [STATE_PUBLISHED, STATE_BUILT, STATE_TO_BUILD, STATE_VERIFIED, STATE_ERROR]
     "List of possible states"
 
-    _instances: List[str] = []
+    _children_version = 0
+    "Increased every time a child is added to any image"
 
     def __init__(
         self,
         root: str,
-        client: docker.client.DockerClient,
+        get_client: Callable[[], docker.client.DockerClient],
         config: Dict,
         nocache: bool = True,
         pull: bool = True,
+        probe: bool = True,
     ):
         self.config = config
         # Create a generic driver to inject in the image.
-        driver = drivers.get(config, client=client, nocache=nocache)
+        driver = drivers.get(config, get_client=get_client, nocache=nocache)
         self.image = image.DockerImage(root, driver, self.config)
-
-        self.state = self.STATE_TO_BUILD
+        self.pull = pull
+        # The set of images tracking the state of this one, if any.
+        self._image_set: Optional["ImageSet"] = None
+        self._state = self.STATE_TO_BUILD
         self.children: Set["ImageFSM"] = set()
-        if pull:
+        self._descendants_cache: Optional[Tuple[int, FrozenSet["ImageFSM"]]] = None
+        if probe:
+            self.probe()
+
+    def probe(self, local_images: Optional[Set[str]] = None):
+        """
+        Set the initial state of the image querying the registry and the local daemon
+
+        local_images: the tags of all the images in the local daemon, if already
+        known. If not, the daemon is asked about this image.
+        """
+        if self.pull:
             # If we allow docker to pull images from the registry,
             # we want to know if an image is already available and
             # not rebuild it.
             if self._is_published():
                 self.state = self.STATE_PUBLISHED
-            elif self.image.exists():
+            elif self._exists(local_images):
                 # We always want to verify the image before publishing!
                 self.state = self.STATE_BUILT
             else:
@@ -69,27 +306,29 @@ class ImageFSM:
         else:
             # If we're not allowing docker to pull images from the registry,
             # we need to build any image that's not already present.
-            if not self.image.exists():
+            if not self._exists(local_images):
                 self.state = self.STATE_TO_BUILD
             elif self._is_published():
                 self.state = self.STATE_PUBLISHED
             else:
                 self.state = self.STATE_BUILT
-        # Register this FSM in the list of instances.
-        # Check that we're not initializing a second instance of the FSM for the same
-        # docker image.
-        # Please note the check happens here, after all non-blocking io is finished, so
-        # the GIL will lock execution in a single thread for us. Still, for clarity to the
-        # reader, and for future-proofing the code here, we explicitly add a mutex.
-        mutex.acquire()
-        if self.image.short_name in ImageFSM._instances:
-            mutex.release()
-            raise RuntimeError(
-                "Trying to reinstantiate the FSM for image {}".format(self.image.short_name)
-            )
-        else:
-            ImageFSM._instances.append(self.image.short_name)
-            mutex.release()
+
+    def _exists(self, local_images: Optional[Set[str]]) -> bool:
+        if local_images is None:
+            return self.image.exists()
+        return self.image.image in local_images
+
+    @property
+    def state(self) -> str:
+        """The current state of the image"""
+        return self._state
+
+    @state.setter
+    def state(self, new_state: str):
+        old_state = self._state
+        self._state = new_state
+        if self._image_set is not None and old_state != new_state:
+            self._image_set.transition(self, old_state)
 
     @property
     def label(self) -> str:
@@ -104,24 +343,18 @@ class ImageFSM:
     def __repr__(self) -> str:
         return "ImageFSM({label}, {state})".format(label=self.label, state=self.state)
 
+    # There can only be one FSM per image, so we identify them by name.
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ImageFSM):
+            return NotImplemented
+        return self.image.short_name == other.image.short_name
+
+    def __hash__(self) -> int:
+        return hash(self.image.short_name)
+
     def _is_published(self) -> bool:
         """Check the registry for the image"""
-        proxies = {"https": self.config.get("http_proxy", None)}
-        if self.config.get("registry", False):
-            url = "https://{registry}/v2".format(registry=self.config["registry"])
-        else:
-            # TODO: support dockerhub somehow!
-            # Probably will need a different strategy there.
-            return False
-        if self.config.get("namespace", False):
-            url += "/{}".format(self.config["namespace"])
-        url += "/{}".format(self.image.short_name)
-        manifest_url = "{url}/manifests/{tag}".format(
-            url=url,
-            tag=self.image.tag,
-        )
-        resp = requests.get(manifest_url, proxies=proxies)
-        return resp.status_code == requests.codes.ok
+        return probe_manifest(self.config, self.image.short_name, self.image.tag)
 
     def build(self):
         """Build the image"""
@@ -164,7 +397,11 @@ class ImageFSM:
 
     def add_child(self, img: "ImageFSM"):
         """Declare another image as child of the current one"""
+        if img in self.children:
+            return
         self.children.add(img)
+        # Any image having this one as a descendant needs to recompute its descendants.
+        ImageFSM._children_version += 1
 
     def all_children(self) -> List["ImageFSM"]:
         """
@@ -176,13 +413,94 @@ class ImageFSM:
 
         Returns: (list) A list of all images that include the current one.
         """
-        children = {self}
-        # This just needs to be a list of images without
-        # duplicates.
-        for child in self.children:
-            children.update(child.all_children())
+        return list(self._descendants())
+
+    def _cached_descendants(self) -> Optional[FrozenSet["ImageFSM"]]:
+        # The cache is valid until a child is added to any image.
+        if self._descendants_cache is not None:
+            version, descendants = self._descendants_cache
+            if version == ImageFSM._children_version:
+                return descendants
+        return None
+
+    def _descendants(self) -> FrozenSet["ImageFSM"]:
+        descendants = self._cached_descendants()
+        if descendants is not None:
+            return descendants
+        # Visit every image in the tree once, reusing the cached results
+        # of the children where available.
+        seen = {self}
+        to_visit = [self]
+        while to_visit:
+            img = to_visit.pop()
+            for child in img.children:
+                if child in seen:
+                    continue
+                cached = child._cached_descendants()
+                if cached is not None:
+                    seen.update(cached)
+                else:
+                    seen.add(child)
+                    to_visit.append(child)
+        descendants = frozenset(seen)
+        self._descendants_cache = (ImageFSM._children_version, descendants)
+        return descendants
+
+
+class ImageSet(MutableSet[ImageFSM]):
+    """
+    A set of ImageFSM objects, indexed by their state.
+
+    The index is kept up to date on state transitions of its members; an image
+    can be tracked by only one ImageSet at a time, the last it was added to.
+    The version is increased at every change of the members or of their states,
+    members_version only when images are added or removed.
+
+    All the changes to the members go through add() and discard(), which keep the
+    index and the versions up to date.
+    """
+
+    def __init__(self, images: Iterable[ImageFSM] = ()):
+        self._images: Set[ImageFSM] = set()
+        self.by_state: Dict[str, Set[ImageFSM]] = {state: set() for state in ImageFSM.STATES}
+        self.version = 0
+        self.members_version = 0
+        for img in images:
+            self.add(img)
 
-        return list(children)
+    def __contains__(self, img: object) -> bool:
+        return img in self._images
+
+    def __iter__(self) -> Iterator[ImageFSM]:
+        return iter(self._images)
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    def add(self, img: ImageFSM):
+        if img in self:
+            return
+        self._images.add(img)
+        self.by_state[img.state].add(img)
+        img._image_set = self
+        self.version += 1
+        self.members_version += 1
+
+    def discard(self, img: object):
+        if not isinstance(img, ImageFSM) or img not in self:
+            return
+        self._images.discard(img)
+        self.by_state[img.state].discard(img)
+        if img._image_set is self:
+            img._image_set = None
+        self.version += 1
+        self.members_version += 1
+
+    def transition(self, img: ImageFSM, old_state: str):
+        """Move an image to the bucket of its new state"""
+        self.by_state[old_state].discard(img)
+        self.by_state[img.state].add(img)
+        self.version += 1
 
 
 class DockerBuilder:
@@ -212,20 +530,18 @@ class DockerBuilder:
         else:
             self.pull = pull
 
+        # Keep the ETags of the registry manifests on disk between runs, see ManifestCache.
+        manifest_cache.persistent = config.get("manifest_cache", True)
+
         # Base images we need to refresh before building, see T219398, as labels.
         self.base_images: List[str] = config.get("base_images", [])
 
-        self.client = docker.from_env(version="auto", timeout=600)
-        # Perform a login if the credentials are provided
-        if all(
-            [self.config.get("username"), self.config.get("password"), self.config.get("registry")]
-        ):
-            self.client.login(
-                username=self.config["username"],
-                password=self.config["password"],
-                registry="https://{}".format(self.config["registry"]),
-                reauth=True,
-            )
+        # The docker client is only created when first needed, see the client property.
+        self._client: Optional[docker.client.DockerClient] = None
+        self._client_lock = Lock()
+        # We only log in to the registry when we first need to talk to it, see _login()
+        self._logged_in = False
+        self._login_lock = Lock()
 
         # We create three lists here:
         # all_images is a set of all the ImageFSMs generated for the images we find in our scan
@@ -238,16 +554,60 @@ class DockerBuilder:
         #
         # TODO: fetch the available images on our default registry too?
         self.known_images: Set[str] = set(self.base_images)
-        self.all_images: Set[ImageFSM] = set()
+        self.all_images = ImageSet()
         self._build_chain: List[ImageFSM] = []
+        # The images and their version the dependency tree was built for.
+        self._dependencies_key: Optional[Tuple[ImageSet, int]] = None
+        # The images, their version and the glob the build chain was computed for.
+        self._build_chain_key: Optional[Tuple[ImageSet, int, Optional[str]]] = None
+        # Index of all_images by short name, and the images and their members
+        # version it was built for, see _img_from_name
+        self._images_by_name: Dict[str, ImageFSM] = {}
+        self._images_by_name_key: Optional[Tuple[ImageSet, int]] = None
+
+    @property
+    def client(self) -> docker.client.DockerClient:
+        """The client for the local docker daemon, shared by all the images"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = docker.from_env(version="auto", timeout=600)
+        return self._client
+
+    @client.setter
+    def client(self, client: docker.client.DockerClient):
+        self._client = client
+
+    @property
+    def all_images(self) -> ImageSet:
+        """All the images we found in our scan"""
+        return self._all_images
+
+    @all_images.setter
+    def all_images(self, images: Iterable[ImageFSM]):
+        self._all_images = ImageSet(images)
+
+    @property
+    def glob(self) -> Optional[str]:
+        """The glob pattern selecting the images to work on"""
+        return self._glob
+
+    @glob.setter
+    def glob(self, selection: Optional[str]):
+        self._glob = selection
+        # Compile the pattern once, instead of at every match.
+        if selection is None:
+            self._glob_re: Optional[Pattern[str]] = None
+        else:
+            self._glob_re = re.compile(fnmatch.translate(selection))
 
     def _matches_glob(self, img: ImageFSM) -> bool:
         """
         Check if the label of an image matches the glob pattern
         """
-        return self.glob is None or fnmatch.fnmatch(img.label, self.glob)
+        return self._glob_re is None or self._glob_re.match(img.label) is not None
 
-    def scan(self, max_workers: int = 1):
+    def scan(self, max_workers: int = 1, probe: bool = True):
         """
         Scan the desired directory for dockerfiles, add them all to a build chain
 
@@ -255,10 +615,44 @@ class DockerBuilder:
         definition of images. For each image found, ``scan`` triggers queries
         to the local Docker daemon and the registry. Passed to
         concurrent.futures.ThreadPoolExecutor(). Default: 1.
+
+        probe: whether to query the local Docker daemon and the registry for the
+        state of the images found. If False, all images are left in the to_build
+        state. Default: True.
         """
+        # Every worker might need its own connection to the registry.
+        ensure_session_pool(max_workers)
+        # Ask the local daemon for all of its images at once, rather than for each image.
+        local_images = self._local_images() if probe else None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Start loading the image definitions while we're still walking the tree.
+            loading = [
+                executor.submit(self._process_dockerfile_template, root)
+                for root in self._image_roots()
+            ]
+            imgs = []
+            probing = []
+            for future in as_completed(loading):
+                img = future.result()
+                self._register(img)
+                imgs.append(img)
+                if probe:
+                    # Query the registry and the local daemon for the state of the image.
+                    probing.append(executor.submit(self._probe_state, img, local_images))
+            for future in probing:
+                future.result()
 
-        roots = []
-        for root, _, files in os.walk(self.root):
+        for img in imgs:
+            self.known_images.add(img.label)
+            self.all_images.add(img)
+        # Let the image_tag filter find the images we just added.
+        dockerfile.TemplateEngine._index_known_images()
+
+    def _image_roots(self) -> Generator[str, None, None]:
+        """Find the directories containing an image definition"""
+        for root, dirs, files in _walk(self.root):
+            # Never descend into hidden directories (.git and the like)
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
             hasTemplate = "Dockerfile.template" in files
             hasChangelog = "changelog" in files
 
@@ -271,39 +665,94 @@ class DockerBuilder:
                 log.warning("Ignoring %s since it lacks a changelog", root)
                 continue
             # We have both files and can proceed this directory
-            roots.append(root)
-
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            imgs = executor.map(self._process_dockerfile_template, roots)
-
-        for img in imgs:
-            self.known_images.add(img.label)
-            self.all_images.add(img)
+            yield root
+            # The rest of the tree is the build context of this image
+            dirs[:] = []
 
     def _process_dockerfile_template(self, root: str) -> ImageFSM:
         log.info("Processing the dockerfile template in %s", root)
         try:
-            return ImageFSM(root, self.client, self.config, self.nocache, self.pull)
+            # The client is only created once an image needs it.
+            return ImageFSM(
+                root, lambda: self.client, self.config, self.nocache, self.pull, probe=False
+            )
         except Exception as e:
             log.error("Could not load image in %s: %s", root, e, exc_info=True)
             raise RuntimeError(
                 "The image in {d} could not be loaded, " "check the logs for details".format(d=root)
             )
 
+    def _login(self):
+        """Perform a login to the registry if the credentials are provided, only once"""
+        with self._login_lock:
+            if self._logged_in:
+                return
+            if (
+                self.config.get("username")
+                and self.config.get("password")
+                and self.config.get("registry")
+            ):
+                self.client.login(
+                    username=self.config["username"],
+                    password=self.config["password"],
+                    registry="https://{}".format(self.config["registry"]),
+                    reauth=True,
+                )
+            self._logged_in = True
+
+    def _register(self, img: ImageFSM):
+        # Check that we're not loading a second definition for the same docker image.
+        if img.image.short_name in self._images_by_name:
+            raise RuntimeError(
+                "Trying to reinstantiate the FSM for image {}".format(img.image.short_name)
+            )
+        self._images_by_name[img.image.short_name] = img
+
+    def _local_images(self) -> Optional[Set[str]]:
+        """The tags of the images present in the local daemon, if we can get them"""
+        try:
+            return {tag for img in self.client.api.images() for tag in img.get("RepoTags") or []}
+        except Exception as e:
+            log.warning("Could not list the local images, will look them up one by one: %s", e)
+            return None
+
+    def _probe_state(self, img: ImageFSM, local_images: Optional[Set[str]] = None):
+        try:
+            img.probe(local_images)
+        except Exception as e:
+            log.error("Could not determine the state of %s: %s", img.label, e, exc_info=True)
+            raise RuntimeError(
+                "The state of image {i} could not be determined, "
+                "check the logs for details".format(i=img.label)
+            )
+
     def images_in_state(self, state: str) -> List[ImageFSM]:
         """Find all images in a specific state"""
         if state not in ImageFSM.STATES:
             raise ValueError("Invalid state {s}".format(s=state))
-        return [img for img in self.all_images if img.state == state]
+        return list(self.all_images.by_state[state])
 
     @property
     def build_chain(self) -> List[ImageFSM]:
+        # The build chain only changes with the images, their state, or the glob.
+        key = self._build_chain_key
+        if (
+            key is not None
+            and key[0] is self.all_images
+            and key[1:] == (self.all_images.version, self.glob)
+        ):
+            return list(self._build_chain)
         # reset the build chain
         self._build_chain = []
+        # Images whose dependencies we're still adding (gray), and images
+        # already in the build chain (black).
+        in_progress: Set[ImageFSM] = set()
+        in_chain: Set[ImageFSM] = set()
         for img in self.images_in_state(ImageFSM.STATE_TO_BUILD):
             if self._matches_glob(img):
-                self._add_deps(img)
-        return self._build_chain
+                self._add_deps(img, in_progress, in_chain)
+        self._build_chain_key = (self.all_images, self.all_images.version, self.glob)
+        return list(self._build_chain)
 
     def prune_chain(self) -> List[ImageFSM]:
         """Returns the images that need to be pruned, in the correct order."""
@@ -317,26 +766,82 @@ class DockerBuilder:
         chain.reverse()
         return chain
 
-    def _add_deps(self, img: ImageFSM):
-        if img in self._build_chain:
+    def prune(self, max_workers: int = 1) -> Generator[Tuple[ImageFSM, bool], None, None]:
+        """
+        Remove the old versions of the images in the prune chain from the local docker daemon
+
+        max_workers: maximum number of images to prune at the same time. As docker
+        refuses to remove images other images are based on, an image is only pruned
+        after all the images depending on it. Passed to
+        concurrent.futures.ThreadPoolExecutor(). Default: 1.
+
+        Yields every image with the outcome of pruning it.
+        """
+        chain = self.prune_chain()
+        # For every image in the prune chain, the images depending on it that
+        # still need to be pruned, and its own dependencies.
+        waiting_for: Dict[ImageFSM, Set[ImageFSM]] = {img: set() for img in chain}
+        blocks: Dict[ImageFSM, Set[ImageFSM]] = {img: set() for img in chain}
+        for img in chain:
+            for name in img.image.depends:
+                dep_img = self._img_from_name(name)
+                if dep_img in waiting_for:
+                    waiting_for[dep_img].add(img)
+                    blocks[img].add(dep_img)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {
+                executor.submit(img.image.driver.prune): img
+                for img in chain
+                if not waiting_for[img]
+            }
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                # Return the images in prune chain order when more than one is done.
+                for future in sorted(done, key=lambda f: chain.index(running[f])):
+                    img = running.pop(future)
+                    for dep_img in blocks[img]:
+                        waiting_for[dep_img].discard(img)
+                        if not waiting_for[dep_img]:
+                            running[executor.submit(dep_img.image.driver.prune)] = dep_img
+                    yield img, future.result()
+
+    def _add_deps(self, img: ImageFSM, in_progress: Set[ImageFSM], in_chain: Set[ImageFSM]):
+        """Add an image to the build chain, after all of its dependencies (depth-first)"""
+        if img in in_chain:
             # the image is already in the build chain, no reason to re-add it.
             # Also, stop going down this tree again
             return
-        for dep in img.image.depends:
-            dep_img = self._img_from_name(dep)
-            # If the parent image doesn't exist or doesn't need to be built,
-            # go on.
-            # TODO: fail if dependency is not found?
-            if dep_img is None or dep_img.state != ImageFSM.STATE_TO_BUILD:
-                continue
-            # TODO: manage the case where the image state is 'error'
-            # Add recursively any dependency of the image
-            self._add_deps(dep_img)
-        # If at this point the image is in the build chain, one of its
-        # dependencies required it. This means we have a circular dependency.
-        if img in self._build_chain:
-            raise RuntimeError("Dependency loop detected for image {image}".format(image=img.image))
-        self._build_chain.append(img)
+        in_progress.add(img)
+        stack = [(img, iter(img.image.depends))]
+        while stack:
+            current, deps = stack[-1]
+            for dep in deps:
+                dep_img = self._img_from_name(dep)
+                # If the parent image doesn't exist or doesn't need to be built,
+                # go on.
+                # TODO: fail if dependency is not found?
+                # TODO: manage the case where the image state is 'error'
+                if dep_img is None or dep_img.state != ImageFSM.STATE_TO_BUILD:
+                    continue
+                if dep_img in in_chain:
+                    continue
+                # If we're still adding the dependencies of this image, one of
+                # them required it. This means we have a circular dependency.
+                if dep_img in in_progress:
+                    raise RuntimeError(
+                        "Dependency loop detected for image {image}".format(image=dep_img.image)
+                    )
+                # Add any dependency of the image before continuing with the next one.
+                in_progress.add(dep_img)
+                stack.append((dep_img, iter(dep_img.image.depends)))
+                break
+            else:
+                # All the dependencies are in the chain now.
+                stack.pop()
+                in_progress.discard(current)
+                in_chain.add(current)
+                self._build_chain.append(current)
 
     def pull_dependencies(self, fsm: ImageFSM):
         """Pulls all dependencies from the docker registry, if they're present"""
@@ -365,12 +870,15 @@ class DockerBuilder:
 
     def images_to_update(self) -> Set[ImageFSM]:
         """Returns a list of images to update"""
-        self._build_dependencies()
-        images_to_update = set()
+        # Only build the dependency tree again if the images changed since the last time.
+        key = self._dependencies_key
+        if key is None or key[0] is not self.all_images or key[1] != self.all_images.version:
+            self._build_dependencies()
+            self._dependencies_key = (self.all_images, self.all_images.version)
+        images_to_update: Set[ImageFSM] = set()
         for img in self.all_images:
             if self._matches_glob(img):
-                for to_update in img.all_children():
-                    images_to_update.add(to_update)
+                images_to_update.update(img.all_children())
         return images_to_update
 
     def update_images(
@@ -378,54 +886,126 @@ class DockerBuilder:
     ):
         """Update the changelog for the images provided"""
         dep_reason = "Refresh for update in parent image {}:\n{}".format(baseimg, reason)
+        if not images:
+            return
+        # The author is the same for all updates, don't ask git for every image.
+        author = next(iter(images)).image._get_author()
         for img in images:
             if img.image.short_name == baseimg:
                 # For the base image, we use the version chosen
                 # on the command line, if any.
-                img.image.create_update(reason, version=version)
+                img.image.create_update(reason, version=version, author=author)
             else:
                 # On the other images, we use a generated change reason instead
                 # and we only increment the minor version automatically.
-                img.image.create_update(dep_reason)
+                img.image.create_update(dep_reason, author=author)
 
     def _img_from_name(self, name: str) -> Optional[ImageFSM]:
         """Retrieve an image given a name"""
-        for img in self.all_images:
-            if img.image.short_name == name:
-                return img
-        return None
+        key = self._images_by_name_key
+        if key is None or key[0] is not self.all_images or key[1] != key[0].members_version:
+            # Images were added or removed, rebuild the index.
+            self._images_by_name = {img.image.short_name: img for img in self.all_images}
+            self._images_by_name_key = (self.all_images, self.all_images.members_version)
+        return self._images_by_name.get(name)
+
+    def build(self, max_workers: int = 1) -> Generator[ImageFSM, None, None]:
+        """
+        Build the images in the build chain
 
-    def build(self) -> Generator[ImageFSM, None, None]:
-        """Build the images in the build chain"""
+        max_workers: maximum number of images to build at the same time. An image
+        is only built once all of its dependencies in the build chain have been
+        processed, and is marked as failed without building it if any of them
+        failed. Passed to concurrent.futures.ThreadPoolExecutor(). Default: 1.
+        """
         # First refresh the base images, to avoid using stale copies of them.
         # See T219398
+        chain = self.build_chain
         if self.pull:
+            self._login()
             for name in self.base_images:
                 log.info("Refreshing %s", name)
                 self.client.images.pull(name)
-        for img in self.build_chain:
-            # If pull is defined, call pull_dependencies()
-            if self.pull:
-                self.pull_dependencies(img)
-            # If we are in a different state now, just return
-            # the image
-            if img.state == ImageFSM.STATE_TO_BUILD:
-                img.build()
-                # We verify each image that we build.
-                # This ensures we run verification at build time even if we won't publish.
-                if img.state == ImageFSM.STATE_BUILT:
-                    img.verify()
-
-            yield img
-
-    def publish(self) -> Generator[ImageFSM, None, None]:
-        """Publish all images to the configured registry"""
+            # Pull the images to reuse cached layers from, once even if several images use them.
+            for name in sorted({src for img in chain for src in img.image.driver.cache_from()}):
+                try:
+                    log.info("Pulling %s to use as build cache", name)
+                    self.client.images.pull(name)
+                except docker.errors.APIError as e:
+                    # Not fatal: docker just won't find cached layers in it.
+                    log.info("Could not pull %s to use as build cache: %s", name, e)
+        # For every image in the build chain, the images it's waiting for, and
+        # the ones waiting for it.
+        waiting_for: Dict[ImageFSM, Set[ImageFSM]] = {img: set() for img in chain}
+        blocks: Dict[ImageFSM, Set[ImageFSM]] = {img: set() for img in chain}
+        for img in chain:
+            for name in img.image.depends:
+                dep_img = self._img_from_name(name)
+                if dep_img in blocks:
+                    waiting_for[img].add(dep_img)
+                    blocks[dep_img].add(img)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {
+                executor.submit(self._build_image, img): img
+                for img in chain
+                if not waiting_for[img]
+            }
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                # Return the images in build chain order when more than one is done.
+                for future in sorted(done, key=lambda f: chain.index(running[f])):
+                    future.result()
+                    finished = [running.pop(future)]
+                    while finished:
+                        img = finished.pop(0)
+                        for child in blocks[img]:
+                            waiting_for[child].discard(img)
+                            if img.state == ImageFSM.STATE_ERROR:
+                                # There's no point in building an image if its parent failed.
+                                if child.state != ImageFSM.STATE_ERROR:
+                                    log.error(
+                                        "Not building %s, as its dependency %s failed",
+                                        child.label,
+                                        img.label,
+                                    )
+                                child.state = ImageFSM.STATE_ERROR
+                            if waiting_for[child]:
+                                continue
+                            if child.state == ImageFSM.STATE_ERROR:
+                                finished.append(child)
+                            else:
+                                running[executor.submit(self._build_image, child)] = child
+                        yield img
+
+    def _build_image(self, img: ImageFSM):
+        # If pull is defined, call pull_dependencies()
+        if self.pull:
+            self.pull_dependencies(img)
+        # If we are in a different state now, just return
+        # the image
+        if img.state == ImageFSM.STATE_TO_BUILD:
+            img.build()
+            # We verify each image that we build.
+            # This ensures we run verification at build time even if we won't publish.
+            if img.state == ImageFSM.STATE_BUILT:
+                img.verify()
+
+    def publish(self, max_workers: int = 1) -> Generator[ImageFSM, None, None]:
+        """
+        Publish all images to the configured registry
+
+        max_workers: maximum number of images to push at the same time. Images
+        are returned as they get published. Passed to
+        concurrent.futures.ThreadPoolExecutor(). Default: 1.
+        """
         if self.config.get("registry") is None:
             log.warning("Cannot publish if no registry is defined")
             return
-        if not all([self.config["username"], self.config["password"]]):
+        if not (self.config["username"] and self.config["password"]):
             log.warning("Cannot publish images if both username and password are not set")
             return
+        self._login()
         # We have two types of images we might publish:
         # - Images we just built (which will be in STATE_VERIFIED)
         # - Images previously built but not published (which will be in STATE_BUILT)
@@ -433,6 +1013,11 @@ class DockerBuilder:
         for img in self.images_in_state((ImageFSM.STATE_BUILT)):
             img.verify()
 
-        for img in self.images_in_state(ImageFSM.STATE_VERIFIED):
-            img.publish()
-            yield img
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pushing = {
+                executor.submit(img.publish): img
+                for img in self.images_in_state(ImageFSM.STATE_VERIFIED)
+            }
+            for future in as_completed(pushing):
+                future.result()
+                yield pushing[future]
@@ -6,11 +6,13 @@ import argparse
 import logging
 import os
 import sys
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 
-import yaml
-
-from docker_pkg import builder, dockerfile, image
+# The modules doing the actual work pull in docker-py, jinja2 and requests, which take
+# much longer to import than anything else. They're imported only once we've parsed the
+# command line, so that --help and usage errors are fast.
+if TYPE_CHECKING:
+    from docker_pkg import builder
 
 defaults: Dict[str, Any] = {
     # Docker registry to use; if empty, no registry will be assumed.
@@ -32,6 +34,10 @@ defaults: Dict[str, Any] = {
     "namespace": "",
     # Number of parallel scan operations to conduct.
     "scan_workers": 8,
+    # Number of images to build in parallel.
+    "build_workers": os.cpu_count() or 1,
+    # Number of images to publish in parallel.
+    "push_workers": 4,
     # Author to fallback to for new changes to create.
     "fallback_author": "Author",
     "fallback_email": "email@domain",
@@ -47,6 +53,16 @@ defaults: Dict[str, Any] = {
     # avoiding the use of non-numeric USER stanzas.
     # We add the debian defaults for a few system users below.
     "known_uid_mappings": {"root": 0, "www-data": 33, "nobody": 65534},
+    # Images to use as a source of cached layers when building with --use-cache. "{name}"
+    # is replaced by the full name of the image being built.
+    "cache_from": [],
+    # Store the ETags of the image manifests found in the registry in
+    # $XDG_CACHE_HOME/docker-pkg/manifests.json, so that later runs can check them with
+    # conditional requests.
+    "manifest_cache": True,
+    # Store the compiled Dockerfile templates in $XDG_CACHE_HOME/docker-pkg/templates, so that
+    # later runs don't need to compile them again.
+    "template_cache": True,
     # The template of the command to run.
     "verify_command": "/bin/bash",
     "verify_args": ["-c", "{path}/test.sh {image}"],
@@ -127,8 +143,18 @@ def parse_args(args: List[str]):
 
 
 def _read_config_file(configfile: str):
+    import yaml
+
+    # Use the libyaml based loader if available
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader  # type: ignore
+
+    # Hand the whole file to the parser at once, rather than having it read the file in chunks.
     with open(configfile, "rb") as fh:
-        config = yaml.safe_load(fh)
+        data = fh.read()
+    config = yaml.load(data, Loader=SafeLoader)
     if config is None:
         return {}
     else:
@@ -158,7 +184,7 @@ def main(args: Optional[argparse.Namespace] = None):
     log_to_stdout = True
     if args is None:
         args = parse_args(sys.argv[1:])
-    logfmt = "%(asctime)s [docker-pkg-build] %(levelname)s - %(message)s (%(filename)s:%(lineno)s)"  # noqa: E501
+    logfmt = "%(asctime)s [docker-pkg-build] %(levelname)s %(name)s - %(message)s (%(filename)s:%(lineno)s)"  # noqa: E501
     datefmt = "%Y-%m-%d %H:%M:%S"
     if args.debug:
         logging.basicConfig(level=logging.DEBUG, format=logfmt, datefmt=datefmt)
@@ -171,6 +197,8 @@ def main(args: Optional[argparse.Namespace] = None):
         )
     config = read_config(args.configfile)
 
+    from docker_pkg import builder, dockerfile, image
+
     # Force requests to use the configured ca bundle.
     if config["ca_bundle"] is not None:
         os.environ["REQUESTS_CA_BUNDLE"] = config["ca_bundle"]
@@ -195,6 +223,8 @@ def main(args: Optional[argparse.Namespace] = None):
 
     application = builder.DockerBuilder(args.directory, config, select, nocache, pull)
     dockerfile.TemplateEngine.setup(application.config, application.known_images)
+    if config["template_cache"]:
+        dockerfile.TemplateEngine.enable_bytecode_cache()
     if args.mode == "build":
         build(application, log_to_stdout)
     elif args.mode == "prune":
@@ -205,7 +235,9 @@ def main(args: Optional[argparse.Namespace] = None):
         raise ValueError(args.action)
 
 
-def build(application: builder.DockerBuilder, log_to_stdout: bool):
+def build(application: "builder.DockerBuilder", log_to_stdout: bool):
+    from docker_pkg import builder
+
     print("== Step 0: scanning {d} ==".format(d=application.root))
     application.scan(max_workers=application.config["scan_workers"])
     print("Will build the following images:")
@@ -213,7 +245,7 @@ def build(application: builder.DockerBuilder, log_to_stdout: bool):
         print("* {image}".format(image=img.label))
 
     print("== Step 1: building images ==")
-    for img in application.build():
+    for img in application.build(max_workers=application.config["build_workers"]):
         if img.state == builder.ImageFSM.STATE_VERIFIED:
             print("* Built image {image}".format(image=img.label))
         else:
@@ -222,10 +254,10 @@ def build(application: builder.DockerBuilder, log_to_stdout: bool):
             )
     # Publishing
     print("== Step 2: publishing ==")
-    if not all([application.config["username"], application.config["password"]]):
+    if not (application.config["username"] and application.config["password"]):
         print("NOT publishing images as we have no auth setup")
     else:
-        for img in application.publish():
+        for img in application.publish(max_workers=application.config["push_workers"]):
             if img.state == builder.ImageFSM.STATE_PUBLISHED:
                 print("Successfully published image {image}".format(image=img.label))
 
@@ -234,7 +266,9 @@ def build(application: builder.DockerBuilder, log_to_stdout: bool):
         print("You can see the logs at ./docker-pkg-build.log")
 
 
-def prune(application: builder.DockerBuilder, nightly: str):
+def prune(application: "builder.DockerBuilder", nightly: str):
+    from docker_pkg import image
+
     # cheat dockerimage into using a fixed format
     if nightly:
         image.DockerImage.NIGHTLY_BUILD_FORMAT = nightly
@@ -247,15 +281,19 @@ def prune(application: builder.DockerBuilder, nightly: str):
         print("* {image}".format(image=fsm.label))
 
     print("== Step 1: pruning images")
-    for fsm in pc:
-        print("* Pruning old versions of {}".format(fsm.label))
-        if not fsm.image.driver.prune():
+    for fsm, success in application.prune(max_workers=application.config["scan_workers"]):
+        if success:
+            print("* Pruned old versions of {}".format(fsm.label))
+        else:
             print("* Errors pruning old images for {}".format(fsm.label))
 
 
-def update(application: builder.DockerBuilder, reason: str, selected: str, version: Optional[str]):
+def update(
+    application: "builder.DockerBuilder", reason: str, selected: str, version: Optional[str]
+):
     print("== Step 0: scanning {d}".format(d=application.root))
-    application.scan()
+    # The state of the images doesn't matter when updating their changelogs.
+    application.scan(max_workers=application.config["scan_workers"], probe=False)
     to_update = application.images_to_update()
     print("Will update the following images: ")
     for fsm in to_update:
@@ -5,47 +5,100 @@ The files are Jinja2 templates, the class provides built-in templates to ease
 writing Dockerfiles.
 """
 
+import functools
+import os
 import re
 
-from typing import Any, Dict, Set
+from typing import Any, Dict, Optional, Set
 
 import debian.debian_support
-from jinja2 import Environment, FileSystemLoader, Template, StrictUndefined
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template, StrictUndefined
 
 from docker_pkg import log, ImageLabel
 
 
+class BytecodeCache(FileSystemBytecodeCache):
+    """On-disk cache of the compiled templates, which never makes a build fail"""
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError as e:
+            log.debug("Could not write the template cache in %s: %s", self.directory, e)
+
+
+# Stands in for the package list when pre-rendering the apt templates.
+PACKAGES_MARKER = "\0packages\0"
+# Turns line breaks and tabs in package lists into spaces.
+PACKAGES_WHITESPACE = str.maketrans("\n\r\t", "   ")
+
+
 class TemplateEngine:
     known_images: Set[str] = set()
     config: Dict[str, Any] = {}
     env: Environment = Environment(extensions=["jinja2.ext.do"], undefined=StrictUndefined)
+    # The known images with a tag, by name. known_images is shared with the builder, which
+    # indexes them again after adding to them.
+    _known_images_by_name: Dict[str, str] = {}
 
     @classmethod
     def setup(cls, config: Dict[str, Any], known_images: Set[str]):
         cls.config = config
         cls.known_images = known_images
+        cls._index_known_images()
         cls.setup_filters()
 
+    @classmethod
+    def enable_bytecode_cache(cls, directory: Optional[str] = None):
+        """
+        Store the compiled templates on disk, so that later runs don't need to compile
+        them again. Jinja checks the source of the template before using the cache.
+
+        directory: where to store the compiled templates.
+        Default: $XDG_CACHE_HOME/docker-pkg/templates.
+        """
+        if directory is None:
+            xdg_cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache/"))
+            directory = os.path.join(xdg_cache_home, "docker-pkg", "templates")
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            log.debug("Not caching compiled templates in %s: %s", directory, e)
+            return
+        cls.env.bytecode_cache = BytecodeCache(directory)
+
+    @classmethod
+    def _index_known_images(cls):
+        images: Dict[str, str] = {}
+        for img_with_tag in cls.known_images:
+            try:
+                name, tag = img_with_tag.split(":")
+            except ValueError:
+                continue
+            images.setdefault(name, img_with_tag)
+        cls._known_images_by_name = images
+
     @classmethod
     def setup_filters(cls):
         cls.setup_apt_install()
         cls.setup_apt_remove()
 
+        # The full name of an image only depends on the configuration, which is fixed
+        # until the next setup.
+        @functools.lru_cache(maxsize=None)
+        def full_name(image_name: str) -> str:
+            return ImageLabel(cls.config, image_name, "").label()
+
         def find_image_tag(image_name):
-            label = ImageLabel(cls.config, image_name, "")
-            image_name = label.label()
-            for img_with_tag in cls.known_images:
-                try:
-                    name, tag = img_with_tag.split(":")
-                except ValueError:
-                    continue
-                if image_name == name:
-                    return img_with_tag
-            raise ValueError(
-                "Image {name} not found, or it has no tag (known={known})".format(
-                    name=image_name, known=cls.known_images
+            image_name = full_name(image_name)
+            try:
+                return cls._known_images_by_name[image_name]
+            except KeyError:
+                raise ValueError(
+                    "Image {name} not found, or it has no tag (known={known})".format(
+                        name=image_name, known=cls.known_images
+                    )
                 )
-            )
 
         cls.env.filters["image_tag"] = find_image_tag
 
@@ -111,11 +164,15 @@ apt-get update {{ apt_options }} \\
     && apt-get clean && rm -rf /var/lib/apt/lists/* """
         )
 
+        # The configuration doesn't change during a run, so we only need to render
+        # the template once, and then to put the packages in place.
+        head, tail = t.render(packages=PACKAGES_MARKER, **cls.config).split(PACKAGES_MARKER)
+
         def apt_install(pkgs):
             # Allow people to write easier to read newline separated package
             # lists by turning them into space separated ones for apt
-            pkgs = pkgs.replace("\n", " ")
-            return t.render(packages=pkgs, **cls.config)
+            pkgs = pkgs.translate(PACKAGES_WHITESPACE)
+            return head + pkgs + tail
 
         cls.env.filters["apt_install"] = apt_install
 
@@ -133,24 +190,32 @@ echo 'Acquire::http::Proxy \"{{ apt_only_proxy }}\";' > /etc/apt/apt.conf.d/80_p
     && apt-get clean && rm -rf /var/lib/apt/lists/* """
         )
 
+        head, tail = t.render(packages=PACKAGES_MARKER, **cls.config).split(PACKAGES_MARKER)
+
         def apt_remove(pkgs):
-            return t.render(packages=pkgs, **cls.config)
+            return head + pkgs + tail
 
         cls.env.filters["apt_remove"] = apt_remove
 
     def __init__(self, path: str):
-        self.env.loader = FileSystemLoader(path)
+        # Use a per-instance overlay of the shared environment, so that templates
+        # from different directories can be rendered concurrently.
+        self.env = self.env.overlay(loader=FileSystemLoader(path))
 
 
 def from_template(path: str, name: str) -> Template:
     return TemplateEngine(path).env.get_template(name)
 
 
+# All the USER instructions in a dockerfile, and the ones with a numeric user.
+USER_LINE_RE = re.compile(r"^USER .*$", re.MULTILINE)
+NUMERIC_USER_RE = re.compile(r"USER\s+\d+(?::\d+)?")
+
+
 def has_numeric_user(dockerfile: str) -> bool:
+    users = USER_LINE_RE.findall(dockerfile)
     # Return true in case dockerfile does not contain a USER instruction
-    numeric_user = True
-    regex = re.compile(r"^USER\s+\d+(?:\:\d+)?$")
-    for line in dockerfile.split("\n"):
-        if line.startswith("USER "):
-            numeric_user = True if regex.match(line) else False
-    return numeric_user
+    if not users:
+        return True
+    # Only the last USER instruction matters
+    return NUMERIC_USER_RE.fullmatch(users[-1]) is not None
@@ -1,6 +1,4 @@
-import os
-from contextlib import contextmanager
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List
 
 import attr
 import docker.errors
@@ -8,19 +6,6 @@ import docker.errors
 from docker_pkg import ImageLabel, log
 
 
-@contextmanager
-def pushd(dirname: str):
-    """
-    Changes the current directory of execution.
-    """
-    cur_dir = os.getcwd()
-    os.chdir(dirname)
-    try:
-        yield
-    finally:
-        os.chdir(cur_dir)
-
-
 @attr.s
 class DriverInterface:
     config: Dict[str, Any] = attr.ib()
@@ -52,6 +37,10 @@ class DriverInterface:
         """Check if a container image exists locally."""
         return False
 
+    def cache_from(self) -> List[str]:
+        """The images the build can reuse cached layers from."""
+        return []
+
     def publish(self, tags: List[str]) -> bool:
         return True
 
@@ -74,9 +63,14 @@ class DockerDriver(DriverInterface):
 
     config: Dict[str, Any] = attr.ib()
     label: ImageLabel = attr.ib()
-    client: docker.client.DockerClient = attr.ib()
+    # Returns the docker client, so that we only connect to the daemon once it's needed.
+    get_client: Callable[[], docker.client.DockerClient] = attr.ib()
     nocache: bool = attr.ib(default=True)
 
+    @property
+    def client(self) -> docker.client.DockerClient:
+        return self.get_client()
+
     def do_build(self, build_path: str, filename: str = "Dockerfile") -> str:
         """
         Builds the image
@@ -114,23 +108,38 @@ class DockerDriver(DriverInterface):
                 # digests or image id after building.
                 return
             else:
-                logger.warning("Unhandled stream chunk: %s" % chunk)
+                logger.warning("Unhandled stream chunk: %s", chunk)
 
         image_logger = log.getChild(self.label.image())
-        with pushd(build_path):
-            for line in self.client.api.build(
-                path=build_path,
-                dockerfile=filename,
-                tag=self.label.image(),
-                nocache=self.nocache,
-                rm=True,
-                pull=False,  # We manage pulling ourselves
-                buildargs=self.buildargs,
-                decode=True,
-            ):
-                stream_to_log(image_logger, line)
+        kwargs = {}
+        cache_from = self.cache_from()
+        if cache_from:
+            kwargs["cache_from"] = cache_from
+        # The build context is sent from build_path, regardless of the working directory:
+        # don't change it, as other images might be building in other threads.
+        for line in self.client.api.build(
+            path=build_path,
+            dockerfile=filename,
+            tag=self.label.image(),
+            nocache=self.nocache,
+            rm=True,
+            pull=False,  # We manage pulling ourselves
+            buildargs=self.buildargs,
+            decode=True,
+            **kwargs,
+        ):
+            stream_to_log(image_logger, line)
         return self.label.image()
 
+    def cache_from(self) -> List[str]:
+        """
+        The images to use as a source of cached layers, as defined by the cache_from
+        configuration. They are only used when building with the cache.
+        """
+        if self.nocache:
+            return []
+        return [ref.format(name=self.label.name()) for ref in self.config.get("cache_from", [])]
+
     def clean(self):
         """Remove the image if needed"""
         try:
@@ -143,9 +152,19 @@ class DockerDriver(DriverInterface):
         if not all(k in self.config for k in ["username", "password"]):
             raise ValueError("Cannot publish without credentials.")
         auth = {"username": self.config["username"], "password": self.config["password"]}
+        image_logger = log.getChild(self.label.image())
+        # Tags are pushed one at a time: all but the first one will find their
+        # layers already in the registry.
         for tag in tags:
             try:
-                self.client.api.push(self.label.name(), tag, auth_config=auth)
+                # Errors during the push are only reported in its output.
+                for chunk in self.client.api.push(
+                    self.label.name(), tag, auth_config=auth, stream=True, decode=True
+                ):
+                    if "error" in chunk:
+                        raise docker.errors.APIError(chunk["error"])
+                    if "status" in chunk:
+                        image_logger.debug("%s %s", chunk.get("id", ""), chunk["status"])
             except docker.errors.APIError as e:
                 log.error("Failed to publish image %s:%s: %s", self.label.label("full"), tag, e)
                 return False
@@ -158,17 +177,18 @@ class DockerDriver(DriverInterface):
         returns True if successful, False otherwise
         """
         success = True
+        current = self.label.image()
         for image in self.client.images.list(self.label.name()):
             # If any of the labels correspond to what declared in the
             # changelog, keep it
             image_aliases = image.attrs["RepoTags"]
-            if not any([(alias == self.label.image()) for alias in image_aliases]):
+            if current not in image_aliases:
                 try:
                     img_id = image.attrs["Id"]
                     log.info('Removing image "%s" (Id: %s)', image_aliases[0], img_id)
                     self.client.images.remove(img_id)
                 except Exception as e:
-                    log.error("Error removing image %s: %s", img_id, str(e))
+                    log.error("Error removing image %s: %s", img_id, e)
                     success = False
         return success
 
@@ -189,10 +209,10 @@ def get(config: Dict[str, Any], **kwargs) -> DriverInterface:
     driver_name = config.get("driver", "docker")
     empty_label = ImageLabel(config, "", "")
     if driver_name == "docker":
-        if "client" not in kwargs:
+        if "get_client" not in kwargs:
             raise ValueError("You need to provide a docker client to the docker driver.")
         return DockerDriver(
-            config, empty_label, kwargs["client"], nocache=kwargs.get("nocache", True)
+            config, empty_label, kwargs["get_client"], nocache=kwargs.get("nocache", True)
         )
     else:
         raise ValueError("Driver {} not supported".format(driver_name))
@@ -3,6 +3,7 @@ Manipulation of Docker images
 """
 
 import datetime
+import functools
 import glob
 import os
 import re
@@ -21,6 +22,34 @@ from debian.deb822 import Packages
 from docker_pkg import ImageLabel, dockerfile, drivers, log
 
 
+@functools.lru_cache(maxsize=None)
+def new_version_re(identifier: str) -> "re.Pattern":
+    """Matches the versions new_tag() knows how to update, for the given identifier"""
+    return re.compile(r"^([\d\-\.]+?)(-{}(\d+))?$".format(re.escape(identifier)))
+
+
+def git_user_config() -> Dict[str, str]:
+    """The user.name and user.email settings from git, with a single git invocation"""
+    output = subprocess.check_output(["git", "config", "--get-regexp", r"^user\.(name|email)$"])
+    config = {}
+    for line in output.decode("utf-8").splitlines():
+        key, _, value = line.partition(" ")
+        config[key] = value.rstrip()
+    return config
+
+
+def link_or_copy(src: str, dst: str) -> str:
+    """
+    Hard link a file into the build context, as docker only reads it. Falls back to
+    copying it, for example if the build context is on a different filesystem.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        return shutil.copy2(src, dst)
+    return dst
+
+
 class DockerImage:
     """
     High-level management of docker images.
@@ -73,7 +102,7 @@ class DockerImage:
     def read_metadata(self, path: str):
         with open(os.path.join(path, "changelog"), "rb") as fh:
             changelog = Changelog(fh)
-        deps = []
+        deps: List[str] = []
         try:
             with open(os.path.join(path, "control"), "rb") as fh:
                 # deb822 might uses python-apt however it is not available
@@ -83,7 +112,7 @@ class DockerImage:
                         deps_str = pkg.get(k, "")
                         if deps_str:
                             # TODO: support versions? not sure it's needed
-                            deps.extend(re.split(r"\s*,[\s\n]*", deps_str))
+                            deps.extend(filter(None, (dep.strip() for dep in deps_str.split(","))))
         except FileNotFoundError:
             # no control file. we can live with that for now.
             pass
@@ -100,9 +129,8 @@ class DockerImage:
         # Note: this only supports a subclass of all valid debian tags.
         if identifier is None:
             identifier = ""
-        re_new_version = re.compile(r"^([\d\-\.]+?)(-{}(\d+))?$".format(identifier))
         previous_version = self.metadata["tag"]
-        m = re_new_version.match(previous_version)
+        m = new_version_re(identifier).match(previous_version)
         if not m:
             raise ValueError("Was not able to match version {}".format(previous_version))
         base, _, seqnum = m.groups()
@@ -113,13 +141,24 @@ class DockerImage:
             patch_num = int(seqnum) + 1
         return "{base}-{sep}{num}".format(base=base, sep=identifier, num=patch_num)
 
-    def create_update(self, reason: str, version: Optional[str] = None):
+    def create_update(
+        self,
+        reason: str,
+        version: Optional[str] = None,
+        author: Optional[Tuple[str, str]] = None,
+    ):
+        """
+        Add an entry to the changelog of the image.
+
+        author: the name and email of the author of the change, as returned by
+        _get_author(), which is called if they're not provided.
+        """
         if version is None:
             version = self.new_tag(identifier=self.config["update_id"])
         changelog_name = os.path.join(self.path, "changelog")
         with open(changelog_name, "rb") as fh:
             changelog = Changelog(fh)
-        fn, email = self._get_author()
+        fn, email = author if author is not None else self._get_author()
 
         changelog.new_block(
             package=self.short_name,
@@ -143,29 +182,17 @@ class DockerImage:
         it reverts to using git configuration data. Finally, a fallback is used,
         provided by the docker-pkg configuration.
         """
-        name = self.config["fallback_author"]
-        email = self.config["fallback_email"]
-        git_failed = False
-        if "DEBFULLNAME" in os.environ:
-            name = os.environ["DEBFULLNAME"]
-        else:
+        name = os.environ.get("DEBFULLNAME")
+        email = os.environ.get("DEBEMAIL")
+        if name is None or email is None:
             try:
-                name = (
-                    subprocess.check_output(["git", "config", "--get", "user.name"])
-                    .rstrip()
-                    .decode("utf-8")
-                )
+                git_config = git_user_config()
             except Exception:
-                git_failed = True
-
-        if "DEBEMAIL" in os.environ:
-            email = os.environ["DEBEMAIL"]
-        elif not git_failed:
-            email = (
-                subprocess.check_output(["git", "config", "--get", "user.email"])
-                .rstrip()
-                .decode("utf-8")
-            )
+                git_config = {}
+            if name is None:
+                name = git_config.get("user.name", self.config["fallback_author"])
+            if email is None:
+                email = git_config.get("user.email", self.config["fallback_email"])
         return (name, email)
 
     @property
@@ -181,16 +208,19 @@ class DockerImage:
         log.info("Generated dockerfile for %s:\n%s", self.label.image(), docker_file)
         if docker_file is None:
             raise RuntimeError("The generated dockerfile is empty")
-
-        output_file = os.path.join(build_path, "Dockerfile")
-        with open(output_file, "w") as fh:
-            fh.write(docker_file)
-
         # Ensure the last USER instruction contains a numeric UID
         if self.config.get("force_numeric_user") and not dockerfile.has_numeric_user(docker_file):
             raise RuntimeError(
                 'Last USER instruction with non-numeric user, see "force_numeric_user" config'
             )
+
+        output_file = os.path.join(build_path, "Dockerfile")
+        # The build context might contain a Dockerfile linked to the one in the image
+        # directory, which we don't want to overwrite.
+        if os.path.lexists(output_file):
+            os.unlink(output_file)
+        with open(output_file, "w") as fh:
+            fh.write(docker_file)
         return output_file
 
     def build(self) -> bool:
@@ -230,22 +260,22 @@ class DockerImage:
         # We take the value of verify_args, and interpolate the current path and
         # the image full name into it. We also check for the existence of all the arguments that
         # are a filesystem path.
-        for arg in self.config["verify_args"]:
-            for part in shlex.split(arg):
-                # Check if arguments that are in the path are indeed present on the filesystem.
-                # If not, assume tests are not implemented for this image, and skip it quickly.
-                if part.find("{path}") < 0:
-                    continue
-                path = part.format(path=self.path)
-                if not os.path.exists(path):
-                    log.info("Could not find path %s, skipping verification of %s", arg, self.name)
-                    return True
+        paths = {
+            part.format(path=self.path)
+            for arg in self.config["verify_args"]
+            for part in shlex.split(arg)
+            if "{path}" in part
+        }
+        # Check if arguments that are in the path are indeed present on the filesystem.
+        # If not, assume tests are not implemented for this image, and skip it quickly.
+        for path in sorted(paths):
+            if not os.path.exists(path):
+                log.info("Could not find path %s, skipping verification of %s", path, self.name)
+                return True
 
         args = [el.format(image=self.image, path=self.path) for el in self.config["verify_args"]]
-        try:
-            executable = self.config["verify_command"]
-            subprocess.run("which {}".format(executable), shell=True, check=True)
-        except subprocess.CalledProcessError:
+        executable = self.config["verify_command"]
+        if shutil.which(executable) is None:
             log.error("Could not verify image %s: %s not found", self.name, executable)
             # This means that if the base executable we need isn't available, we will refuse to
             # publish any image.
@@ -269,19 +299,18 @@ class DockerImage:
 
     def _dockerignore(self):
         dockerignore = os.path.join(self.path, ".dockerignore")
-        ignored = []
+        ignored = set()
         if not os.path.isfile(dockerignore):
             return None
         with open(dockerignore, "r") as fh:
-            for line in fh.readlines():
+            for line in fh:
                 # WARNING: does NOT support inline comments
                 if line.startswith("#"):
                     continue
                 clean_line = line.strip()
                 if not clean_line:
                     continue
-                for filepath in glob.glob(os.path.join(self.path, clean_line)):
-                    ignored.append(filepath)
+                ignored.update(glob.glob(os.path.join(self.path, clean_line)))
 
         if not ignored:
             return None
@@ -304,7 +333,9 @@ class DockerImage:
         base = tempfile.mkdtemp(prefix="docker-pkg-{name}".format(name=self.safe_name))
         build_path = os.path.join(base, "context")
 
-        shutil.copytree(self.path, build_path, ignore=self._dockerignore())
+        shutil.copytree(
+            self.path, build_path, ignore=self._dockerignore(), copy_function=link_or_copy
+        )
         return build_path
 
     def _clean_build_environment(self, build_path: str):
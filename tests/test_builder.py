@@ -1,55 +1,96 @@
 import copy
 import logging
 import os
+import tempfile
 from pathlib import Path
 import unittest
 from concurrent.futures import ThreadPoolExecutor
-from unittest.mock import MagicMock, call, patch
+from unittest.mock import ANY, MagicMock, call, patch
 
-from docker_pkg import dockerfile, drivers, image
-from docker_pkg.builder import DockerBuilder, ImageFSM
+import docker.errors
+import requests
+
+from docker_pkg import builder, dockerfile, drivers, image
+from docker_pkg.builder import DockerBuilder, ImageFSM, ManifestCache
 
 from tests import fixtures_dir
 
 
+def test_walk():
+    expected = [(root, sorted(dirs), set(files)) for root, dirs, files in os.walk(fixtures_dir)]
+    actual = [(root, sorted(dirs), files) for root, dirs, files in builder._walk(fixtures_dir)]
+    assert sorted(actual) == sorted(expected)
+
+
+@patch("docker_pkg.builder.session_pool_size", 32)
+def test_ensure_session_pool():
+    with patch("docker_pkg.builder.session.mount") as mount:
+        builder.ensure_session_pool(8)
+        mount.assert_not_called()
+        builder.ensure_session_pool(64)
+        adapter = mount.call_args[0][1]
+        assert adapter._pool_maxsize == 64
+        assert 503 in adapter.max_retries.status_forcelist
+        assert builder.session_pool_size == 64
+
+
 class TestImageFSM(unittest.TestCase):
     default_configuration = {"base_images": ["test:123"]}
 
     def setUp(self):
-        ImageFSM._instances = []
         dockerfile.TemplateEngine.setup({}, [])
         with patch("docker.from_env") as client:
             self.img = ImageFSM(
                 os.path.join(fixtures_dir, "foo-bar"),
-                client,
+                lambda: client,
                 copy.deepcopy(self.default_configuration),
             )
 
     def test_init(self):
         self.assertIsInstance(self.img.image, image.DockerImage)
         self.assertEqual(self.img.children, set())
-        # Reinitializing the same image raises an error
-        self.assertRaises(
-            RuntimeError,
-            ImageFSM,
-            os.path.join(fixtures_dir, "foo-bar"),
-            MagicMock(),  # here should go a docker client
-            self.default_configuration,
-        )
 
     @patch("docker.from_env")
     @patch("docker_pkg.image.DockerImage.exists")
     def test_image_state(self, exists, client):
         exists.return_value = True
-        ImageFSM._instances = []
         # We set up no registry, thus we can't have a published image.
-        img = ImageFSM(os.path.join(fixtures_dir, "foo-bar"), client, self.default_configuration)
+        img = ImageFSM(os.path.join(fixtures_dir, "foo-bar"), lambda: client, self.default_configuration)
         self.assertEqual(img.state, ImageFSM.STATE_BUILT)
-        ImageFSM._instances = []
         exists.return_value = False
-        img = ImageFSM(os.path.join(fixtures_dir, "foo-bar"), client, self.default_configuration)
+        img = ImageFSM(os.path.join(fixtures_dir, "foo-bar"), lambda: client, self.default_configuration)
         self.assertEqual(img.state, ImageFSM.STATE_TO_BUILD)
 
+    @patch("docker.from_env")
+    @patch("docker_pkg.image.DockerImage.exists")
+    def test_deferred_probe(self, exists, client):
+        exists.return_value = True
+        img = ImageFSM(
+            os.path.join(fixtures_dir, "foo-bar"), lambda: client, self.default_configuration, probe=False
+        )
+        # No query is performed until we probe the image explicitly.
+        self.assertEqual(img.state, ImageFSM.STATE_TO_BUILD)
+        exists.assert_not_called()
+        img.probe()
+        self.assertEqual(img.state, ImageFSM.STATE_BUILT)
+
+    @patch("docker.from_env")
+    def test_eq(self, client):
+        img = ImageFSM(
+            os.path.join(fixtures_dir, "foo-bar"), lambda: client, self.default_configuration, probe=False
+        )
+        other = ImageFSM(
+            os.path.join(fixtures_dir, "foobar-server"),
+            lambda: client,
+            self.default_configuration,
+            probe=False,
+        )
+        # Images are identified by their name
+        self.assertEqual(img, self.img)
+        self.assertEqual(len({img, self.img}), 1)
+        self.assertNotEqual(img, other)
+        self.assertNotEqual(img, "foo-bar")
+
     def test_label(self):
         self.assertEqual(self.img.label, "foo-bar:0.0.1")
         self.img.image.label.namespace = "test"
@@ -59,9 +100,83 @@ class TestImageFSM(unittest.TestCase):
     def test_name(self):
         self.assertEqual(self.img.name, "foo-bar")
 
+    def test_manifest_cache_not_persistent(self):
+        url = "https://example.org/v2/foo-bar/manifests/0.0.1"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ManifestCache(os.path.join(tmpdir, "manifests.json"), persistent=False)
+            cache.update(url, '"abc"', 200)
+            self.assertIsNone(cache.etag(url))
+            self.assertEqual(os.listdir(tmpdir), [])
+
     def test_repr(self):
         self.assertEqual(repr(self.img), "ImageFSM(foo-bar:0.0.1, built)")
 
+    def test_is_published_etag(self):
+        self.img.config["registry"] = "example.org"
+        url = "https://example.org/v2/foo-bar/manifests/0.0.1"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ManifestCache(os.path.join(tmpdir, "manifests.json"))
+            with patch("docker_pkg.builder.manifest_cache", cache), patch(
+                "docker_pkg.builder.session.head"
+            ) as head:
+                # First lookup is unconditional, and stores the ETag.
+                head.return_value = MagicMock(status_code=200, headers={"ETag": '"abc"'})
+                self.assertTrue(self.img._is_published())
+                head.assert_called_with(
+                    url,
+                    proxies={"https": None},
+                    headers={"Accept": builder.MANIFEST_MEDIA_TYPES},
+                    timeout=ANY,
+                    allow_redirects=True,
+                )
+                # Within the same run, we don't need to look it up again.
+                self.assertTrue(self.img._is_published())
+                self.assertEqual(head.call_count, 1)
+            # In subsequent runs lookups are conditional, and a 304 means published.
+            cache = ManifestCache(cache.path)
+            with patch("docker_pkg.builder.manifest_cache", cache), patch(
+                "docker_pkg.builder.session.head"
+            ) as head:
+                head.return_value = MagicMock(status_code=304, headers={})
+                self.assertTrue(self.img._is_published())
+                head.assert_called_with(
+                    url,
+                    proxies={"https": None},
+                    headers={"Accept": builder.MANIFEST_MEDIA_TYPES, "If-None-Match": '"abc"'},
+                    timeout=ANY,
+                    allow_redirects=True,
+                )
+            cache = ManifestCache(cache.path)
+            with patch("docker_pkg.builder.manifest_cache", cache), patch(
+                "docker_pkg.builder.session.head"
+            ) as head:
+                head.return_value = MagicMock(status_code=404, headers={})
+                self.assertFalse(self.img._is_published())
+                # Images not found are looked up again.
+                self.assertFalse(self.img._is_published())
+                self.assertEqual(head.call_count, 2)
+
+    @patch("docker_pkg.builder.session.head")
+    def test_is_published_url(self, head):
+        head.return_value = MagicMock(status_code=404, headers={})
+        # No registry, no lookup
+        self.assertFalse(self.img._is_published())
+        head.assert_not_called()
+        self.img.config["registry"] = "example.org"
+        self.img.config["namespace"] = "ns"
+        self.assertFalse(self.img._is_published())
+        head.assert_called_with(
+            "https://example.org/v2/ns/foo-bar/manifests/0.0.1",
+            proxies={"https": None},
+            headers={"Accept": builder.MANIFEST_MEDIA_TYPES},
+            timeout=ANY,
+            allow_redirects=True,
+        )
+        # Registry errors are not taken as the image being absent
+        head.return_value = requests.Response()
+        head.return_value.status_code = 503
+        self.assertRaises(requests.HTTPError, self.img._is_published)
+
     @patch("docker_pkg.image.DockerImage.build")
     def test_build(self, build):
         # An already built image doesn't get built again
@@ -109,16 +224,13 @@ class TestDockerBuilder(unittest.TestCase):
         dockerfile.TemplateEngine.setup({}, [])
         with patch("docker.from_env"):
             self.builder = DockerBuilder(fixtures_dir, copy.deepcopy(self.default_configuration))
-        ImageFSM._instances = []
+            self.builder.client
 
     def img_metadata(self, name, tag, deps):
         img = ImageFSM(
-            os.path.join(fixtures_dir, "foo-bar"), self.builder.client, self.builder.config
+            os.path.join(fixtures_dir, "foo-bar"), lambda: self.builder.client, self.builder.config
         )
         img.image.label.short_name = name
-        # Clean up the images registry before initiating images this way.
-        ImageFSM._instances.pop()
-        ImageFSM._instances.append(name)
         img.image.label.version = tag
         img.image.metadata["depends"] = deps
         img.state = ImageFSM.STATE_TO_BUILD
@@ -136,9 +248,23 @@ class TestDockerBuilder(unittest.TestCase):
         db = DockerBuilder("test", {"base_images": ["foo:0.0.1", "bar:1.0.0"]})
         self.assertEqual(db.known_images, {"foo:0.0.1", "bar:1.0.0"})
         self.assertIsNone(db.glob)
+        # We don't log in to the registry until we need to
+        db = DockerBuilder("test", {"username": "foo", "password": "bar", "registry": "example.org"})
+        db.client.login.assert_not_called()
+        # The docker client is only created once, when first needed
+        client.reset_mock()
+        db = DockerBuilder("test", {})
+        client.assert_not_called()
+        self.assertIs(db.client, db.client)
+        client.assert_called_once_with(version="auto", timeout=600)
+        # The manifest cache can be kept off disk
+        with patch("docker_pkg.builder.manifest_cache", ManifestCache()) as cache:
+            DockerBuilder("test", {"manifest_cache": False})
+            self.assertFalse(cache.persistent)
 
     def test_scan(self):
         self.assertEqual(self.builder.known_images, {"test"})
+        dockerfile.TemplateEngine.setup({}, self.builder.known_images)
         with patch("docker_pkg.drivers.DockerDriver.exists") as mocker:
             mocker.return_value = False
             self.builder.scan()
@@ -149,6 +275,9 @@ class TestDockerBuilder(unittest.TestCase):
                 "upstream-version-extended:1.63.0-1-20241211"
             }
         )
+        # The scanned images can be found by the image_tag filter
+        image_tag = dockerfile.TemplateEngine.env.filters["image_tag"]
+        self.assertEqual(image_tag("foo-bar"), "foo-bar:0.0.1")
         # Build chain is complete, and correctly ordered
         bc = [img.label for img in self.builder.build_chain]
         self.assertCountEqual(bc, {
@@ -158,9 +287,42 @@ class TestDockerBuilder(unittest.TestCase):
         })
         self.assertLess(bc.index("foo-bar:0.0.1"), bc.index("foobar-server:0.0.1~alpha1"))
 
+    def test_scan_no_probe(self):
+        with patch("docker_pkg.drivers.DockerDriver.exists") as mocker:
+            self.builder.scan(probe=False)
+        mocker.assert_not_called()
+        self.assertEqual(len(self.builder.all_images), 4)
+        self.assertEqual(len(self.builder.images_in_state(ImageFSM.STATE_TO_BUILD)), 4)
+
+    def test_scan_lists_local_images_once(self):
+        self.builder.client.api.images.return_value = [
+            {"RepoTags": ["foo-bar:0.0.1", "foo-bar:latest"]},
+            {"RepoTags": None},
+        ]
+        with patch("docker_pkg.drivers.DockerDriver.exists") as exists, patch(
+            "docker_pkg.builder.ImageFSM._is_published", return_value=False
+        ):
+            self.builder.scan()
+        exists.assert_not_called()
+        self.builder.client.api.images.assert_called_once_with()
+        self.assertEqual(
+            self.builder._img_from_name("foo-bar").state, ImageFSM.STATE_BUILT
+        )
+        self.assertEqual(len(self.builder.images_in_state(ImageFSM.STATE_TO_BUILD)), 3)
+
+    def test_scan_local_images_fallback(self):
+        # If the daemon can't list its images, they're looked up one by one
+        self.builder.client.api.images.side_effect = docker.errors.APIError("boom")
+        with patch("docker_pkg.drivers.DockerDriver.exists", return_value=True) as exists, patch(
+            "docker_pkg.builder.ImageFSM._is_published", return_value=False
+        ):
+            self.builder.scan()
+        self.assertEqual(exists.call_count, 4)
+        self.assertEqual(len(self.builder.images_in_state(ImageFSM.STATE_BUILT)), 4)
+
     def test_scan_skips_when_missing_changelog(self):
-        with patch("os.walk") as os_walk:
-            os_walk.return_value = [("image_with_template", [], ["Dockerfile.template"])]
+        with patch("docker_pkg.builder._walk") as walk:
+            walk.return_value = [("image_with_template", [], ["Dockerfile.template"])]
             with self.assertLogs(level="WARNING") as logger:
                 self.builder.scan()
                 self.assertEqual(
@@ -169,8 +331,8 @@ class TestDockerBuilder(unittest.TestCase):
                 )
 
     def test_scan_skips_when_missing_dockerfile_template(self):
-        with patch("os.walk") as os_walk:
-            os_walk.return_value = [("image_with_changelog", [], ["changelog"])]
+        with patch("docker_pkg.builder._walk") as walk:
+            walk.return_value = [("image_with_changelog", [], ["changelog"])]
             with self.assertLogs(level="WARNING") as logger:
                 self.builder.scan()
                 self.assertEqual(
@@ -181,17 +343,38 @@ class TestDockerBuilder(unittest.TestCase):
                 )
 
     def test_scan_silently_skips_when_missing_dockerfile_template_and_changelog(self):
-        with patch("os.walk") as os_walk:
-            os_walk.return_value = [("image_with_no_files", [], [])]
+        with patch("docker_pkg.builder._walk") as walk:
+            walk.return_value = [("image_with_no_files", [], [])]
             with self.assertLogs() as logger:
                 self.builder.scan()
                 # assertLogs() requires at least one message
                 logging.getLogger("dummy").info("fakemessage")
                 self.assertEqual(logger.output, ["INFO:dummy:fakemessage"])
 
+    def test_scan_prunes_descent(self):
+        image_dirs = ["files", ".git"]
+        with patch("docker_pkg.builder._walk") as walk:
+            walk.return_value = [
+                (
+                    os.path.join(fixtures_dir, "foo-bar"),
+                    image_dirs,
+                    ["changelog", "control", "Dockerfile.template"],
+                ),
+            ]
+            self.builder.scan()
+        # We don't descend in the image directory
+        self.assertEqual(image_dirs, [])
+
+    def test_register(self):
+        a = self.img_metadata("a", "1.0", [])
+        self.builder._register(a)
+        self.assertEqual(self.builder._images_by_name, {"a": a})
+        # Registering a second image with the same name raises an error
+        self.assertRaises(RuntimeError, self.builder._register, self.img_metadata("a", "1.1", []))
+
     def test_scan_raises_if_duplicate(self):
-        with patch("os.walk") as os_walk:
-            os_walk.return_value = [
+        with patch("docker_pkg.builder._walk") as walk:
+            walk.return_value = [
                 (
                     os.path.join(fixtures_dir, "foo-bar"),
                     [],
@@ -206,6 +389,24 @@ class TestDockerBuilder(unittest.TestCase):
             with self.assertRaises(RuntimeError):
                 self.builder.scan(max_workers=4)
 
+    def test_img_from_name(self):
+        a = self.img_metadata("a", "1.0", [])
+        b = self.img_metadata("b", "1.0", ["a"])
+        self.builder.all_images = set([a, b])
+        self.assertEqual(self.builder._img_from_name("a"), a)
+        self.assertIsNone(self.builder._img_from_name("unicorn"))
+        # State changes don't invalidate the index
+        index = self.builder._images_by_name
+        b.state = ImageFSM.STATE_BUILT
+        self.assertEqual(self.builder._img_from_name("b"), b)
+        self.assertIs(self.builder._images_by_name, index)
+        # The index follows changes to all_images
+        self.builder.all_images.remove(a)
+        self.assertIsNone(self.builder._img_from_name("a"))
+        a1 = self.img_metadata("a", "1.1", [])
+        self.builder.all_images.add(a1)
+        self.assertEqual(self.builder._img_from_name("a"), a1)
+
     def test_build_chain(self):
         # Simple test for a linear dependency tree
         a = self.img_metadata("a", "1.0", [])
@@ -247,6 +448,33 @@ class TestDockerBuilder(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             self.builder.build_chain
 
+    def test_build_chain_cached(self):
+        a = self.img_metadata("a", "1.0", [])
+        b = self.img_metadata("b", "1.0", ["a"])
+        self.builder.all_images = set([a, b])
+        with patch.object(self.builder, "_add_deps", wraps=self.builder._add_deps) as add_deps:
+            self.assertEqual(self.builder.build_chain, [a, b])
+            self.assertEqual(self.builder.build_chain, [a, b])
+            self.assertEqual(add_deps.call_count, 2)
+            # A state transition invalidates the build chain
+            a.state = ImageFSM.STATE_PUBLISHED
+            self.assertEqual(self.builder.build_chain, [b])
+            self.assertEqual(add_deps.call_count, 3)
+        # The returned list can be modified safely
+        self.builder.build_chain.clear()
+        self.assertEqual(self.builder.build_chain, [b])
+
+    def test_build_chain_deep(self):
+        # Deep dependency trees don't hit the recursion limit
+        images = [self.img_metadata("img0", "1.0", [])]
+        for i in range(1, 1200):
+            images.append(self.img_metadata("img{}".format(i), "1.0", ["img{}".format(i - 1)]))
+        self.builder.all_images = set(images)
+        self.builder.glob = "img1199:*"
+        self.assertListEqual(self.builder.build_chain, images)
+        self.builder.glob = "img0:*"
+        self.assertEqual(self.builder.images_to_update(), set(images))
+
     def test_prune_chain(self):
         """Test that the prune chain behaves as expected."""
         # Simple test for a linear dependency tree
@@ -265,6 +493,50 @@ class TestDockerBuilder(unittest.TestCase):
         pc = self.builder.prune_chain()
         self.assertEqual(pc, [d, c])
 
+    def test_prune_parallel(self):
+        a = self.img_metadata("a", "1.0", [])
+        b = self.img_metadata("b", "1.0", ["a"])
+        c = self.img_metadata("c", "1.0", ["a"])
+        d = self.img_metadata("d", "1.0", ["b", "c", "b"])
+        e = self.img_metadata("e", "1.0", [])
+        self.builder.all_images = set([a, b, c, d, e])
+        pruned = []
+
+        def prune(driver):
+            name = driver.label.short_name
+            # Images are pruned only after all the images depending on them.
+            for img in self.builder.all_images:
+                if name in img.image.depends:
+                    self.assertIn(img.image.short_name, pruned)
+            pruned.append(name)
+            return name != "d"
+
+        with patch("docker_pkg.drivers.DockerDriver.prune", autospec=True, side_effect=prune):
+            result = dict(self.builder.prune(max_workers=4))
+        self.assertCountEqual(pruned, ["a", "b", "c", "d", "e"])
+        self.assertEqual(result, {a: True, b: True, c: True, d: False, e: True})
+
+    def test_update_images(self):
+        a = self.img_metadata("a", "1.0", [])
+        b = self.img_metadata("b", "1.0", ["a"])
+        c = self.img_metadata("c", "1.0", ["b"])
+        with patch("docker_pkg.image.DockerImage._get_author") as get_author, patch(
+            "docker_pkg.image.DockerImage.create_update"
+        ) as create_update:
+            get_author.return_value = ("Foo", "foo@example.org")
+            self.builder.update_images({a, b, c}, "reason", "a", version="1.1")
+        get_author.assert_called_once_with()
+        author = ("Foo", "foo@example.org")
+        dep_reason = "Refresh for update in parent image a:\nreason"
+        create_update.assert_has_calls(
+            [
+                call("reason", version="1.1", author=author),
+                call(dep_reason, author=author),
+                call(dep_reason, author=author),
+            ],
+            any_order=True,
+        )
+
     def test_build_dependencies(self):
         # Simple test for a linear dependency tree
         a = self.img_metadata("a", "1.0", [])
@@ -285,6 +557,17 @@ class TestDockerBuilder(unittest.TestCase):
             RuntimeError, r"Image unicorn .* not found", self.builder._build_dependencies
         )
 
+    def test_all_children(self):
+        a = self.img_metadata("a", "1.0", [])
+        b = self.img_metadata("b", "1.0", ["a"])
+        c = self.img_metadata("c", "1.0", ["b"])
+        a.add_child(b)
+        self.assertCountEqual(a.all_children(), [a, b])
+        # Adding a grandchild is reflected in the result
+        b.add_child(c)
+        self.assertCountEqual(a.all_children(), [a, b, c])
+        self.assertCountEqual(c.all_children(), [c])
+
     def test_images_to_update(self):
         a = self.img_metadata("a", "1.0", [])
         b = self.img_metadata("b", "1.0", ["a"])
@@ -295,7 +578,13 @@ class TestDockerBuilder(unittest.TestCase):
         self.builder.glob = "*c:*"
         assert self.builder.images_to_update() == {c, d}
         self.builder.glob = "*a:*"
-        assert self.builder.images_to_update() == {a, b, c, d}
+        with patch.object(self.builder, "_build_dependencies") as build_deps:
+            assert self.builder.images_to_update() == {a, b, c, d}
+            # The dependency tree is only built again when the images change
+            build_deps.assert_not_called()
+            self.builder.all_images.remove(f)
+            self.builder.images_to_update()
+            build_deps.assert_called_once_with()
 
     @patch("docker_pkg.drivers.DockerDriver.exists")
     @patch("docker_pkg.image.DockerImage.build")
@@ -308,10 +597,10 @@ class TestDockerBuilder(unittest.TestCase):
         # Assume verification is successful
         verify.return_value = True
         img0 = ImageFSM(
-            os.path.join(fixtures_dir, "foo-bar"), self.builder.client, self.builder.config
+            os.path.join(fixtures_dir, "foo-bar"), lambda: self.builder.client, self.builder.config
         )
         img1 = ImageFSM(
-            os.path.join(fixtures_dir, "foobar-server"), self.builder.client, self.builder.config
+            os.path.join(fixtures_dir, "foobar-server"), lambda: self.builder.client, self.builder.config
         )
         self.builder.all_images = set([img0, img1])
         result = [r for r in self.builder.build()]
@@ -325,6 +614,53 @@ class TestDockerBuilder(unittest.TestCase):
         self.assertEqual("foobar-server:0.0.1~alpha1", result[1].label)
         self.assertEqual("error", result[1].state)
 
+    @patch("docker_pkg.image.DockerImage.verify")
+    def test_build_parallel(self, verify):
+        verify.return_value = True
+        a = self.img_metadata("a", "1.0", [])
+        b = self.img_metadata("b", "1.0", ["a"])
+        c = self.img_metadata("c", "1.0", ["a"])
+        d = self.img_metadata("d", "1.0", ["b", "c"])
+        e = self.img_metadata("e", "1.0", [])
+        self.builder.all_images = set([a, b, c, d, e])
+        built = []
+
+        def build(img):
+            # All dependencies are done before an image gets built.
+            for dep in img.image.depends:
+                self.assertIn(dep, built)
+            built.append(img.image.short_name)
+            img.state = ImageFSM.STATE_BUILT
+
+        with patch("docker_pkg.builder.ImageFSM.build", autospec=True, side_effect=build):
+            result = [r for r in self.builder.build(max_workers=4)]
+        self.assertCountEqual(result, [a, b, c, d, e])
+        self.assertCountEqual(built, ["a", "b", "c", "d", "e"])
+        for img in result:
+            self.assertEqual(img.state, ImageFSM.STATE_VERIFIED)
+
+    @patch("docker_pkg.image.DockerImage.verify")
+    def test_build_parent_failed(self, verify):
+        verify.return_value = True
+        a = self.img_metadata("a", "1.0", [])
+        b = self.img_metadata("b", "1.0", ["a"])
+        c = self.img_metadata("c", "1.0", ["b"])
+        d = self.img_metadata("d", "1.0", [])
+        self.builder.all_images = set([a, b, c, d])
+
+        def build(img):
+            img.state = ImageFSM.STATE_ERROR if img == a else ImageFSM.STATE_BUILT
+
+        with patch(
+            "docker_pkg.builder.ImageFSM.build", autospec=True, side_effect=build
+        ) as mock_build:
+            result = [r for r in self.builder.build(max_workers=2)]
+        # The children of the failed image are not built, but still reported.
+        self.assertCountEqual(mock_build.call_args_list, [call(a), call(d)])
+        self.assertCountEqual(result, [a, b, c, d])
+        self.assertEqual(c.state, ImageFSM.STATE_ERROR)
+        self.assertEqual(d.state, ImageFSM.STATE_VERIFIED)
+
     @patch("docker_pkg.drivers.DockerDriver.exists")
     @patch("docker_pkg.image.DockerImage.build")
     @patch("docker_pkg.image.DockerImage.verify")
@@ -361,10 +697,10 @@ class TestDockerBuilder(unittest.TestCase):
 
         pull.side_effect = pull_result
         img0 = ImageFSM(
-            os.path.join(fixtures_dir, "foo-bar"), self.builder.client, self.builder.config
+            os.path.join(fixtures_dir, "foo-bar"), lambda: self.builder.client, self.builder.config
         )
         img1 = ImageFSM(
-            os.path.join(fixtures_dir, "foobar-server"), self.builder.client, self.builder.config
+            os.path.join(fixtures_dir, "foobar-server"), lambda: self.builder.client, self.builder.config
         )
         img0.state = ImageFSM.STATE_TO_BUILD
         img1.state = ImageFSM.STATE_TO_BUILD
@@ -376,12 +712,44 @@ class TestDockerBuilder(unittest.TestCase):
         pull.assert_has_calls([call(img0), call(img1)])
         assert build.call_count == 1
 
+    @patch("docker_pkg.builder.ImageFSM.build", autospec=True)
+    def test_build_pull_cache_from(self, build):
+        self.builder.config["cache_from"] = ["{name}:latest", "base:1.0"]
+        self.builder.base_images = []
+        images = []
+        for name in ["foo-bar", "foobar-server"]:
+            img = ImageFSM(
+                os.path.join(fixtures_dir, name),
+                lambda: self.builder.client,
+                self.builder.config,
+                nocache=False,
+                pull=False,
+                probe=False,
+            )
+            images.append(img)
+        self.builder.all_images = set(images)
+        self.builder.pull = False
+        list(self.builder.build())
+        self.builder.client.images.pull.assert_not_called()
+        self.builder.pull = True
+        self.builder.client.images.pull.side_effect = [
+            None, docker.errors.NotFound("nope"), None
+        ]
+        with patch("docker_pkg.builder.DockerBuilder.pull_dependencies"):
+            list(self.builder.build())
+        # Each source is pulled once, failures are not fatal
+        self.assertCountEqual(
+            self.builder.client.images.pull.call_args_list,
+            [call("base:1.0"), call("foo-bar:latest"), call("foobar-server:latest")],
+        )
+        self.assertEqual(build.call_count, 4)
+
     def test_pull_images(self):
         img0 = ImageFSM(
-            os.path.join(fixtures_dir, "foo-bar"), self.builder.client, self.builder.config
+            os.path.join(fixtures_dir, "foo-bar"), lambda: self.builder.client, self.builder.config
         )
         img1 = ImageFSM(
-            os.path.join(fixtures_dir, "foobar-server"), self.builder.client, self.builder.config
+            os.path.join(fixtures_dir, "foobar-server"), lambda: self.builder.client, self.builder.config
         )
         img0.state = ImageFSM.STATE_BUILT
         img1.state = ImageFSM.STATE_TO_BUILD
@@ -396,15 +764,36 @@ class TestDockerBuilder(unittest.TestCase):
 
     def test_images_in_state(self):
         img0 = ImageFSM(
-            os.path.join(fixtures_dir, "foo-bar"), self.builder.client, self.builder.config
+            os.path.join(fixtures_dir, "foo-bar"), lambda: self.builder.client, self.builder.config
         )
         img1 = ImageFSM(
-            os.path.join(fixtures_dir, "foobar-server"), self.builder.client, self.builder.config
+            os.path.join(fixtures_dir, "foobar-server"), lambda: self.builder.client, self.builder.config
         )
         img0.state = ImageFSM.STATE_BUILT
         img1.state = ImageFSM.STATE_ERROR
         self.builder.all_images = set([img0, img1])
         self.assertEqual([img0], self.builder.images_in_state(ImageFSM.STATE_BUILT))
+        # State transitions and changes to the set of images are tracked
+        img1.state = ImageFSM.STATE_BUILT
+        self.assertCountEqual([img0, img1], self.builder.images_in_state(ImageFSM.STATE_BUILT))
+        self.assertEqual([], self.builder.images_in_state(ImageFSM.STATE_ERROR))
+        self.builder.all_images.remove(img0)
+        self.assertEqual([img1], self.builder.images_in_state(ImageFSM.STATE_BUILT))
+        self.assertRaises(ValueError, self.builder.images_in_state, "unicorn")
+        # Every way of changing the set keeps the index up to date
+        images = self.builder.all_images
+        version = images.members_version
+        images |= {img0}
+        self.assertCountEqual([img0, img1], self.builder.images_in_state(ImageFSM.STATE_BUILT))
+        images -= {img1}
+        self.assertEqual([img0], self.builder.images_in_state(ImageFSM.STATE_BUILT))
+        images.pop()
+        self.assertEqual([], self.builder.images_in_state(ImageFSM.STATE_BUILT))
+        images.add(img1)
+        images.clear()
+        self.assertEqual([], self.builder.images_in_state(ImageFSM.STATE_BUILT))
+        self.assertEqual(images.members_version, version + 5)
+        self.assertFalse(hasattr(images, "update"))
 
     @patch("docker_pkg.image.DockerImage.verify")
     def test_publish(self, verify):
@@ -415,11 +804,11 @@ class TestDockerBuilder(unittest.TestCase):
         with patch("docker_pkg.builder.ImageFSM._is_published") as mp:
             mp.return_value = False
             img0 = ImageFSM(
-                os.path.join(fixtures_dir, "foo-bar"), self.builder.client, self.builder.config
+                os.path.join(fixtures_dir, "foo-bar"), lambda: self.builder.client, self.builder.config
             )
             img1 = ImageFSM(
                 os.path.join(fixtures_dir, "foobar-server"),
-                self.builder.client,
+                lambda: self.builder.client,
                 self.builder.config,
             )
         # One image was already built, the other was verified.
@@ -440,6 +829,28 @@ class TestDockerBuilder(unittest.TestCase):
             "example.org/foobar-server",
             "0.0.1~alpha1",
             auth_config={"username": "foo", "password": "bar"},
+            stream=True,
+            decode=True,
         )
         # Only one image needed to be verified before publishing.
         self.assertEqual(verify.call_count, 1)
+        # We logged in to the registry, only once.
+        self.builder.client.login.assert_called_once_with(
+            username="foo", password="bar", registry="https://example.org", reauth=True
+        )
+        list(self.builder.publish())
+        self.assertEqual(self.builder.client.login.call_count, 1)
+
+    @patch("docker_pkg.image.DockerImage.publish")
+    def test_publish_parallel(self, publish):
+        publish.return_value = True
+        images = [self.img_metadata(name, "1.0", []) for name in ["a", "b", "c"]]
+        self.builder.config.update({"username": "foo", "password": "bar", "registry": "example.org"})
+        for img in images:
+            img.state = ImageFSM.STATE_VERIFIED
+        self.builder.all_images = set(images)
+        result = list(self.builder.publish(max_workers=3))
+        self.assertCountEqual(result, images)
+        self.assertEqual(publish.call_count, 3)
+        for img in images:
+            self.assertEqual(img.state, ImageFSM.STATE_PUBLISHED)
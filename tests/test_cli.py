@@ -1,11 +1,15 @@
 from contextlib import contextmanager
 from copy import deepcopy
 import os
+import subprocess
+import sys
 import unittest
 
 from unittest.mock import call, patch, MagicMock, mock_open
 
 import docker_pkg.cli
+from docker_pkg import dockerfile
+from docker_pkg.builder import DockerBuilder
 from docker_pkg.image import DockerImage
 from tests import fixtures_dir
 
@@ -24,6 +28,12 @@ def ignore_user_config():
 
 
 class TestCli(unittest.TestCase):
+    def setUp(self):
+        # Don't store compiled templates in the home of whoever runs the tests.
+        patcher = patch("docker_pkg.dockerfile.TemplateEngine.enable_bytecode_cache")
+        self.enable_bytecode_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch("docker_pkg.builder.DockerBuilder")
     def test_main_build(self, builder):
         application = builder.return_value
@@ -43,6 +53,7 @@ class TestCli(unittest.TestCase):
                 docker_pkg.cli.main(args)
             builder.assert_called_with(fixtures_dir, docker_pkg.cli.defaults, "python*", True, True)
             b.assert_called_with(application, False)
+            self.enable_bytecode_cache.assert_called_with()
             args.info = True
             docker_pkg.cli.main(args)
             b.assert_called_with(application, True)
@@ -70,6 +81,17 @@ class TestCli(unittest.TestCase):
                 fixtures_dir, docker_pkg.cli.defaults, "python*", True, False
             )
 
+    @patch("docker_pkg.builder.DockerBuilder")
+    def test_main_no_template_cache(self, builder):
+        args = MagicMock()
+        args.mode = "prune"
+        args.info = False
+        config = dict(docker_pkg.cli.defaults, template_cache=False)
+        with patch("docker_pkg.cli.read_config", return_value=config):
+            with patch("docker_pkg.cli.prune"):
+                docker_pkg.cli.main(args)
+        self.enable_bytecode_cache.assert_not_called()
+
     @patch("docker_pkg.builder.DockerBuilder")
     def test_main_update(self, builder):
         application = builder.return_value
@@ -175,3 +197,33 @@ class TestCli(unittest.TestCase):
             self.assertEquals(
                 "local value", conf.get("foo"), "local value takes precedence over user config"
             )
+
+    def test_update_scan_workers(self):
+        application = MagicMock()
+        application.config = {"scan_workers": 5}
+        application.images_to_update.return_value = set()
+        docker_pkg.cli.update(application, "reason", "python", None)
+        application.scan.assert_called_with(max_workers=5, probe=False)
+        application.update_images.assert_called_with(set(), "reason", "python", version=None)
+
+    @patch("docker.from_env")
+    def test_update_without_docker(self, client):
+        # Adding changelog entries never connects to the docker daemon
+        dockerfile.TemplateEngine.setup({}, [])
+        application = DockerBuilder(
+            fixtures_dir, {"base_images": [], "scan_workers": 1}, "foo-bar:*"
+        )
+        with patch.object(application, "update_images") as update_images:
+            docker_pkg.cli.update(application, "reason", "foo-bar", None)
+        updated = {img.image.short_name for img in update_images.call_args[0][0]}
+        self.assertIn("foo-bar", updated)
+        client.assert_not_called()
+
+    def test_lazy_imports(self):
+        # Parsing the command line doesn't need docker-py, jinja2 or yaml
+        code = (
+            "import sys, docker_pkg.cli; docker_pkg.cli.parse_args(['build', 'dir']); "
+            "print(' '.join(m for m in ('docker', 'jinja2', 'yaml') if m in sys.modules))"
+        )
+        out = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+        self.assertEqual(out.strip(), "")
@@ -41,3 +41,12 @@ class TestDocker_pkg(unittest.TestCase):
             "image",
             "version",
         )
+
+    def test_image_label_changes(self):
+        label = ImageLabel({}, "image", "version")
+        self.assertEqual(label.image(), "image:version")
+        # Cached labels follow changes to their components
+        label.registry = "docker-registry.example.org"
+        label.version = "1.0"
+        self.assertEqual(label.image(), "docker-registry.example.org/image:1.0")
+        self.assertRaises(ValueError, label.label, "unicorn")
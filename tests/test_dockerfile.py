@@ -1,6 +1,9 @@
+import os
+
 import pytest
 
 from docker_pkg import dockerfile
+from tests import fixtures_dir
 
 
 def test_dockerfile_has_numeric_user():
@@ -8,3 +11,61 @@ def test_dockerfile_has_numeric_user():
     assert dockerfile.has_numeric_user("RUN but\nNo user at all")
     assert dockerfile.has_numeric_user("USER root\nPrivileged\nUSER 123:12")
     assert dockerfile.has_numeric_user("USER 1000")
+    assert dockerfile.has_numeric_user("FROM foo\nUSER 1000\n")
+    assert dockerfile.has_numeric_user("USER 123\nUSER 1000 # comment") is False
+    # Only USER instructions at the start of a line count
+    assert dockerfile.has_numeric_user("USER 1000\nRUN echo USER root")
+
+
+@pytest.mark.parametrize("proxy", [None, "http://proxy:8080"])
+def test_apt_filters(proxy):
+    dockerfile.TemplateEngine.setup({"apt_only_proxy": proxy, "apt_options": "-q"}, set())
+    apt_install = dockerfile.TemplateEngine.env.filters["apt_install"]
+    apt_remove = dockerfile.TemplateEngine.env.filters["apt_remove"]
+    install = apt_install("curl\r\n\twget")
+    assert "apt-get update -q \\\n" in install
+    assert "apt-get install -q --yes curl   wget --no-install-recommends" in install
+    assert "apt-get remove --yes --purge curl wget \\\n" in apt_remove("curl wget")
+    for rendered in (install, apt_remove("curl")):
+        assert rendered.endswith("&& apt-get clean && rm -rf /var/lib/apt/lists/* ")
+        assert ('Acquire::http::Proxy "http://proxy:8080";' in rendered) == bool(proxy)
+        assert ("rm -f /etc/apt/apt.conf.d/80_proxy" in rendered) == bool(proxy)
+
+
+def test_image_tag_filter():
+    known_images = {"foo:1.0", "registry:5000/bar", "baz"}
+    dockerfile.TemplateEngine.setup({}, known_images)
+    image_tag = dockerfile.TemplateEngine.env.filters["image_tag"]
+    assert image_tag("foo") == "foo:1.0"
+    for name in ["bar", "baz", "unicorn"]:
+        with pytest.raises(ValueError):
+            image_tag(name)
+    # Images added after setup are found once they're indexed again
+    known_images.add("unicorn:0.1")
+    dockerfile.TemplateEngine._index_known_images()
+    assert image_tag("unicorn") == "unicorn:0.1"
+    # And so are replaced images, even if the number of images doesn't change
+    known_images.remove("unicorn:0.1")
+    known_images.add("unicorn:0.2")
+    dockerfile.TemplateEngine._index_known_images()
+    assert image_tag("unicorn") == "unicorn:0.2"
+    known_images.remove("unicorn:0.2")
+    # A new setup takes the new configuration into account
+    known_images.add("example.org/unicorn:0.2")
+    dockerfile.TemplateEngine.setup({"registry": "example.org"}, known_images)
+    image_tag = dockerfile.TemplateEngine.env.filters["image_tag"]
+    assert image_tag("unicorn") == "example.org/unicorn:0.2"
+
+
+def test_bytecode_cache(tmp_path):
+    dockerfile.TemplateEngine.setup({}, {"foo-bar:0.0.1"})
+    try:
+        dockerfile.TemplateEngine.enable_bytecode_cache(str(tmp_path))
+        path = os.path.join(fixtures_dir, "foobar-server")
+        template = dockerfile.from_template(path, "Dockerfile.template")
+        assert len(os.listdir(str(tmp_path))) == 1
+        # Templates loaded from the cache render the same
+        cached = dockerfile.from_template(path, "Dockerfile.template")
+        assert cached.render() == template.render()
+    finally:
+        dockerfile.TemplateEngine.env.bytecode_cache = None
@@ -18,7 +18,7 @@ class TestDockerDriver(unittest.TestCase):
         self.docker = MagicMock()
         self.config = {}
         self.label = ImageLabel(self.config, "image_name", "image_tag")
-        self.driver = drivers.DockerDriver(self.config, self.label, self.docker, True)
+        self.driver = drivers.DockerDriver(self.config, self.label, lambda: self.docker, True)
 
     def test_init(self):
         self.assertEqual(self.driver.client, self.docker)
@@ -97,6 +97,34 @@ class TestDockerDriver(unittest.TestCase):
         with self.assertRaises(docker.errors.BuildError):
             self.driver.do_build("/tmp", filename="test")
 
+    def test_build_cache_from(self):
+        self.driver.config["cache_from"] = ["{name}:latest", "base:1.0"]
+        # Not used when building without the cache
+        self.assertEqual(self.driver.cache_from(), [])
+        self.driver.do_build("/tmp", filename="test")
+        self.assertNotIn("cache_from", self.docker.api.build.call_args[1])
+        self.driver.nocache = False
+        self.driver.do_build("/tmp", filename="test")
+        self.assertEqual(
+            self.docker.api.build.call_args[1]["cache_from"],
+            ["image_name:latest", "base:1.0"],
+        )
+        # Pulling the sources is up to the builder
+        self.docker.images.pull.assert_not_called()
+
+    def test_build_keeps_cwd(self):
+        """Building doesn't change the working directory of the process"""
+        cwd = os.getcwd()
+        cwds = []
+
+        def build(**kwargs):
+            cwds.append(os.getcwd())
+            return []
+
+        self.docker.api.build.side_effect = build
+        self.driver.do_build("/tmp", filename="/tmp/Dockerfile")
+        self.assertEqual(cwds, [cwd])
+
     def test_publish_no_credentials(self):
         """Publishing without credentials raises an Exception"""
         with self.assertRaises(ValueError):
@@ -107,7 +135,27 @@ class TestDockerDriver(unittest.TestCase):
         self.driver.config["username"] = "u"
         self.driver.config["password"] = "p"
         self.driver.client.api.push = MagicMock()
+        self.driver.client.api.push.return_value = [
+            {"status": "Layer already exists", "id": "abc"},
+            {"status": "sometag: digest: sha256:123 size: 42"},
+        ]
         self.assertTrue(self.driver.publish(["sometag"]))
         self.driver.client.api.push.assert_called_with(
-            "image_name", "sometag", auth_config={"username": "u", "password": "p"}
+            "image_name",
+            "sometag",
+            auth_config={"username": "u", "password": "p"},
+            stream=True,
+            decode=True,
         )
+
+    def test_publish_error(self):
+        """Errors reported while pushing make publishing fail"""
+        self.driver.config["username"] = "u"
+        self.driver.config["password"] = "p"
+        self.driver.client.api.push = MagicMock()
+        self.driver.client.api.push.return_value = [
+            {"status": "Preparing", "id": "abc"},
+            {"error": "denied: requested access to the resource is denied"},
+        ]
+        self.assertFalse(self.driver.publish(["sometag", "latest"]))
+        self.assertEqual(self.driver.client.api.push.call_count, 1)
@@ -1,6 +1,9 @@
 import copy
 import datetime
 import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 
 from unittest.mock import MagicMock, patch, mock_open, call, ANY
@@ -23,7 +26,7 @@ class TestDockerImage(unittest.TestCase):
         self.docker = MagicMock()
         self.config = {}
         dockerfile.TemplateEngine.setup(self.config, [])
-        driver = drivers.get(self.config, client=self.docker, nocache=True)
+        driver = drivers.get(self.config, get_client=lambda: self.docker, nocache=True)
         self.basedir = os.path.join(fixtures_dir, "foo-bar")
         self.image = image.DockerImage(self.basedir, driver, self.config)
         image.DockerImage.is_nightly = False
@@ -39,6 +42,14 @@ class TestDockerImage(unittest.TestCase):
         self.assertEqual(img.tag, "0.0.1-{}".format(date))
         image.DockerImage.is_nightly = False
 
+    def test_read_metadata_depends(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shutil.copy(os.path.join(self.basedir, "changelog"), tmpdir)
+            with open(os.path.join(tmpdir, "control"), "w") as fh:
+                fh.write("Package: foo-bar\nBuild-Depends: builder\nDepends: foo,bar ,\n baz,\n")
+            self.image.read_metadata(tmpdir)
+        self.assertEqual(self.image.depends, ["builder", "foo", "bar", "baz"])
+
     def test_safe_name(self):
         self.image.label.short_name = "team-foo/test-app"
         self.assertEqual(self.image.safe_name, "team-foo-test-app")
@@ -99,6 +110,25 @@ class TestDockerImage(unittest.TestCase):
             self.image.write_dockerfile(be)
             self.assertTrue(os.path.isfile(os.path.join(be, "Dockerfile")))
 
+    def test_build_environment_links(self):
+        """The build context links to the image files, without modifying them"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            basedir = os.path.join(tmpdir, "foo-bar")
+            shutil.copytree(self.basedir, basedir)
+            with open(os.path.join(basedir, "Dockerfile"), "w") as fh:
+                fh.write("FROM unicorn\n")
+            img = image.DockerImage(basedir, self.image.driver, self.config)
+            with patch("tempfile.tempdir", tmpdir):
+                with img.build_environment() as be:
+                    self.assertTrue(
+                        os.path.samefile(
+                            os.path.join(be, "test.sh"), os.path.join(basedir, "test.sh")
+                        )
+                    )
+                    img.write_dockerfile(be)
+            with open(os.path.join(basedir, "Dockerfile")) as fh:
+                self.assertEqual(fh.read(), "FROM unicorn\n")
+
     def test_new_tag(self):
         # First test, check a native tag
         self.image.metadata["tag"] = "0.1.2"
@@ -109,6 +139,11 @@ class TestDockerImage(unittest.TestCase):
         # With a different separator
         self.image.metadata["tag"] = "0.1.2-1"
         self.assertEqual(self.image.new_tag(identifier=""), "0.1.2-2")
+        # The separator is matched literally
+        self.image.metadata["tag"] = "0.1.2-x3"
+        self.assertRaises(ValueError, self.image.new_tag, identifier=".")
+        self.image.metadata["tag"] = "0.1.2-.3"
+        self.assertEqual(self.image.new_tag(identifier="."), "0.1.2-.4")
         # Finally an invalid version number. Please note this is valid in strict
         # debian terms but I don't consider this a particular limitation, as
         # image creators should use SemVer.
@@ -125,8 +160,17 @@ class TestDockerImage(unittest.TestCase):
         # Unset debemail
         del os.environ["DEBEMAIL"]
         with patch("subprocess.check_output") as co:
-            co.return_value = b"other@example.com\n"
+            co.return_value = b"user.name Bar Baz\nuser.email other@example.com\n"
             self.assertEqual(self.image._get_author(), ("Foo", "other@example.com"))
+            del os.environ["DEBFULLNAME"]
+            self.assertEqual(self.image._get_author(), ("Bar Baz", "other@example.com"))
+            # Both settings come from a single git call
+            self.assertEqual(co.call_count, 2)
+            # Settings missing from git use the fallback
+            co.return_value = b"user.name Bar Baz\n"
+            self.assertEqual(self.image._get_author(), ("Bar Baz", "admin@example.org"))
+            co.side_effect = subprocess.CalledProcessError(1, "git")
+            self.assertEqual(self.image._get_author(), ("joe", "admin@example.org"))
 
     def test_create_change(self):
         m = mock_open(read_data="")
@@ -148,7 +192,9 @@ class TestDockerImage(unittest.TestCase):
     def test_verify_image_no_executable(self):
         self.image.config["verify_command"] = "/nonexistent"
         self.image.config["verify_args"] = []
-        self.assertFalse(self.image.verify())
+        with patch("subprocess.run") as run:
+            self.assertFalse(self.image.verify())
+        run.assert_not_called()
 
     def test_verify_failure(self):
         self.image.config = defaults